@@ -1,81 +1,350 @@
 import math
-
-
-class Node:
-    def __init__(self, point, h, cost):
-        self.point = point
-        self.g = math.inf
-        self.h = h
-        self.cost = cost
-        self.parent = None
-
-    def __eq__(self, other):
-        return self.point == other.point
+import heapq
+import numpy as np
+from scipy.ndimage import binary_dilation
+from grid import get_topology, EIGHT_CONNECTED
 
 
 def distance(point1, point2):
     return math.sqrt((point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2)
 
 
-def get_neighbors(point, grid):
-    """
-    Returns a list of all neighbor points
-    """
-    points = [(point[0] + 1, point[1]),
-              (point[0] + 1, point[1] + 1),
-              (point[0]    , point[1] + 1),
-              (point[0] - 1, point[1] + 1),
-              (point[0] - 1, point[1]),
-              (point[0] - 1, point[1] - 1),
-              (point[0]    , point[1] - 1),
-              (point[0] + 1, point[1] - 1)]
-    return [p for p in points if (0 <= p[0] < len(grid)) and (0 <= p[1] < len(grid[0]))]
-
-
-def astar(grid, start, goal):
+def astar(grid, start, goal, connectivity=8):
     """
     Given a matrix of costs and start/end points, find the shortest path.
-    Considers a cost of None to be an obstacle
+    Considers a cost of None (or any non-finite cost) to be an obstacle
     :param grid: np matrix of costs for each square
     :param start: (x, y) tuple coordinates of start point
     :param goal: (x, y) tuple coordinates of end point
-    :return: list of (x, y) coordinates that define the path from start to goal
+    :param connectivity: 8 to allow diagonal moves, 4 to only move along rows and columns
+    :return: list of (x, y) coordinates that define the path from start to goal, or None if there is no path
     """
+    costs = np.asarray(grid, dtype=np.float64)
+    topology = get_topology(costs.shape, connectivity)
+    flat_costs = costs.ravel()
+    passable = np.isfinite(flat_costs)
+
+    # all search state lives in flat arrays indexed by row * width + col
+    g = np.full(topology.size, math.inf)
+    parent = np.full(topology.size, -1, dtype=np.int64)
+    closed = np.zeros(topology.size, dtype=bool)
+
+    start_index = topology.to_index(start)
+    goal_index = topology.to_index(goal)
+    g[start_index] = 0
 
-    open = {}
-    closed = {}
-    start_node = Node(start, distance(start, goal), min(grid[start[0]][start[1]], 10)) # use min in case we start out of bounds
-    start_node.g = 0
-    open[start] = start_node
-    while open:
-        current = sorted(list(open.values()), key=lambda node: node.g + node.h + node.cost)[0]
-        open.pop(current.point)
-
-        if current.point == goal:
-            path = [current.point]
-            while current.parent:
-                path.append(current.parent)
-                current = closed[current.parent]
+    # the open list is a heap of (f, insertion order, index); stale entries are skipped when popped.
+    # insertion order breaks ties the same way the old sorted() open list did
+    counter = 0
+    start_cost = min(costs[start], 10)  # use min in case we start out of bounds
+    open_heap = [(distance(start, goal) + start_cost, counter, start_index)]
+
+    while open_heap:
+        _, _, current_index = heapq.heappop(open_heap)
+        if closed[current_index]:
+            continue
+
+        if current_index == goal_index:
+            path = [goal]
+            while parent[current_index] >= 0:
+                current_index = parent[current_index]
+                path.append(topology.to_point(current_index))
             path.reverse()
             return path
 
-        closed[current.point] = current
-        for neighbor_point in get_neighbors(current.point, grid):
-            if neighbor_point in closed:
+        closed[current_index] = True
+        current_cost = start_cost if current_index == start_index else flat_costs[current_index]
+
+        base_g = g[current_index] + current_cost
+        for offset, step in topology.offset_steps(current_index):
+            neighbor_index = current_index + offset
+            if closed[neighbor_index] or not passable[neighbor_index]:
                 continue
 
-            if neighbor_point not in open:
-                neighbor_cost = grid[neighbor_point[0]][neighbor_point[1]]
-                neighbor = Node(neighbor_point, distance(neighbor_point, goal), neighbor_cost)
+            new_g = base_g + step
+            if new_g < g[neighbor_index]:
+                g[neighbor_index] = new_g
+                parent[neighbor_index] = current_index
+                counter += 1
+                neighbor_f = new_g + topology.distance(neighbor_index, goal_index) + flat_costs[neighbor_index]
+                heapq.heappush(open_heap, (neighbor_f, counter, neighbor_index))
+
+    return None
+
+
+# cell states for JumpPointMap
+UNIFORM = 0  # (nearly) free to cross, jumped over
+NEAR_WEIGHTED = 1  # uniform, but next to a weighted cell so it is expanded normally
+WEIGHTED = 2  # has a cost, expanded normally
+BLOCKED = 3  # obstacle or outside the map
+
+
+class JumpPointMap:
+    """
+    Jump Point Search version of astar() for cost maps that are mostly open floor.
+    Cells with a cost of at most uniform_cost are treated as uniform, and straight or diagonal runs across
+    them are jumped over instead of expanding every cell. Weighted cells, and uniform cells next to them,
+    fall back to regular A* expansion, and maps that are mostly weighted are handed to astar() entirely.
+    Paths are optimal when uniform cells cost exactly 0.
+
+    Where every straight jump ends is worked out for the whole map when it is created (as in JPS+),
+    so one map can answer many searches as long as the costs stay the same.
+    """
+
+    def __init__(self, grid, uniform_cost=0.01):
+        """
+        :param grid: np matrix of costs for each square, non-finite costs are obstacles
+        :param uniform_cost: largest cost that still counts as open floor
+        """
+        self.costs = np.asarray(grid, dtype=np.float64)
+        height, width = self.costs.shape
+
+        # pad the map with a border of blocked cells so jumps never need bounds checks
+        self.width = width + 2
+        padded_costs = np.zeros((height + 2, self.width))
+        padded_costs[1:-1, 1:-1] = self.costs
+        weighted = np.isfinite(padded_costs) & (padded_costs > uniform_cost)
+        states = np.full((height + 2, self.width), UNIFORM, dtype=np.uint8)
+        states[binary_dilation(weighted, structure=np.ones((3, 3), dtype=bool))] = NEAR_WEIGHTED
+        states[weighted] = WEIGHTED
+        states[~np.isfinite(padded_costs)] = BLOCKED
+        states[[0, -1], :] = BLOCKED
+        states[:, [0, -1]] = BLOCKED
+
+        # jumping only adds overhead to a regular search when most of the map is weighted
+        self.mostly_weighted = np.count_nonzero(states == UNIFORM) < np.count_nonzero(states != BLOCKED) / 2
+        if self.mostly_weighted:
+            return
+
+        # python lists are much faster than numpy arrays for the one cell at a time work in find_path
+        self.state = states.ravel().tolist()
+        self.cell_costs = padded_costs.ravel().tolist()
+        self.straight_ends, self.straight_prefix = {}, {}
+        for direction in ((1, 0), (0, 1), (-1, 0), (0, -1)):
+            ends, prefix = straight_jumps(states, padded_costs, direction)
+            self.straight_ends[direction] = ends.ravel().tolist()
+            # only read twice per straight jump, so not worth converting
+            self.straight_prefix[direction] = prefix.ravel()
+
+    def find_path(self, start, goal):
+        """
+        Given start/end points, find the shortest path.
+        :param start: (x, y) tuple coordinates of start point
+        :param goal: (x, y) tuple coordinates of end point
+        :return: list of (x, y) coordinates that define the path from start to goal, or None if there is no path
+        """
+        if self.mostly_weighted:
+            return astar(self.costs, start, goal)
+
+        width = self.width
+        state = self.state
+        cell_costs = self.cell_costs
+        straight_ends = self.straight_ends
+        straight_prefix = self.straight_prefix
+
+        def to_point(index):
+            row, col = divmod(index, width)
+            return row - 1, col - 1
+
+        start_index = (start[0] + 1) * width + start[1] + 1
+        goal_index = (goal[0] + 1) * width + goal[1] + 1
+        goal_row, goal_col = divmod(goal_index, width)
+        start_cost = min(self.costs[start], 10)  # use min in case we start out of bounds
+
+        def heuristic(index):
+            row, col = divmod(index, width)
+            return math.sqrt((row - goal_row) ** 2 + (col - goal_col) ** 2)
+
+        def jump(index, d_row, d_col, cost):
+            """
+            Moves from index in one direction until reaching a jump point.
+            :param cost: cost of the cell being left
+            :return: (jump point, cost of getting there from index), or None if the direction is a dead end
+            """
+            offset = d_row * width + d_col
+            if not (d_row and d_col):
+                end = straight_ends[d_row, d_col][index]
+                blocked = end < 0
+                if blocked:
+                    end = -end - 1
+                # the tables don't know about the goal, so check whether it is on the way
+                steps = (goal_index - index) // offset
+                if 0 < steps and index + steps * offset == goal_index and \
+                        (steps < (end - index) // offset or (steps == (end - index) // offset and not blocked)):
+                    end, blocked = goal_index, False
+                if blocked:
+                    return None
+                # one step and the cost of the cell being left for every cell, like the diagonal loop below
+                prefix = straight_prefix[d_row, d_col]
+                return end, (end - index) // offset + cost + float(prefix[end - offset] - prefix[index])
+
+            row_ends, col_ends = straight_ends[d_row, 0], straight_ends[0, d_col]
+            row, col = divmod(index, width)
+            step = math.sqrt(2)
+            total = 0
+            while True:
+                total += step + cost
+                index += offset
+                row += d_row
+                col += d_col
+                cell = state[index]
+                if cell == BLOCKED:
+                    return None
+                # stopping wherever the goal's row or column is crossed lets a straight jump find the goal
+                if cell != UNIFORM or row == goal_row or col == goal_col:
+                    return index, total
+                cost = cell_costs[index]
+                if (state[index - d_row * width] == BLOCKED and state[index - d_row * width + d_col] != BLOCKED) or \
+                        (state[index - d_col] == BLOCKED and state[index + d_row * width - d_col] != BLOCKED):
+                    return index, total
+                if row_ends[index] >= 0 or col_ends[index] >= 0:
+                    return index, total
+
+        def directions(index, parent_index):
+            # natural and forced neighbor directions of a uniform cell, given the direction it was reached from
+            row, col = divmod(index, width)
+            parent_row, parent_col = divmod(parent_index, width)
+            d_row = (row > parent_row) - (row < parent_row)
+            d_col = (col > parent_col) - (col < parent_col)
+            if d_row and d_col:
+                result = [(d_row, 0), (0, d_col), (d_row, d_col)]
+                if state[index - d_row * width] == BLOCKED and state[index - d_row * width + d_col] != BLOCKED:
+                    result.append((-d_row, d_col))
+                if state[index - d_col] == BLOCKED and state[index + d_row * width - d_col] != BLOCKED:
+                    result.append((d_row, -d_col))
+            elif d_col:
+                result = [(0, d_col)]
+                for side in (1, -1):
+                    if state[index + side * width] == BLOCKED and state[index + side * width + d_col] != BLOCKED:
+                        result.append((side, d_col))
+            else:
+                result = [(d_row, 0)]
+                for side in (1, -1):
+                    if state[index + side] == BLOCKED and state[index + d_row * width + side] != BLOCKED:
+                        result.append((d_row, side))
+            return result
+
+        g = {start_index: 0}
+        parents = {}
+        closed = set()
+        counter = 0
+        open_heap = [(heuristic(start_index) + start_cost, counter, start_index)]
+
+        while open_heap:
+            _, _, current_index = heapq.heappop(open_heap)
+            if current_index in closed:
+                continue
+
+            if current_index == goal_index:
+                return expand_jumps(current_index, parents, width, to_point)
+
+            closed.add(current_index)
+            if current_index == start_index:
+                current_cost = start_cost
+                current_directions = EIGHT_CONNECTED
             else:
-                neighbor = open[neighbor_point]
+                current_cost = cell_costs[current_index]
+                if state[current_index] == UNIFORM:
+                    current_directions = directions(current_index, parents[current_index])
+                else:
+                    current_directions = EIGHT_CONNECTED
+
+            for d_row, d_col in current_directions:
+                result = jump(current_index, d_row, d_col, current_cost)
+                if result is None:
+                    continue
+                neighbor_index, segment_cost = result
+                if neighbor_index in closed:
+                    continue
+                new_g = g[current_index] + segment_cost
+                if new_g < g.get(neighbor_index, math.inf):
+                    g[neighbor_index] = new_g
+                    parents[neighbor_index] = current_index
+                    counter += 1
+                    heapq.heappush(open_heap, (new_g + heuristic(neighbor_index) + cell_costs[neighbor_index],
+                                               counter, neighbor_index))
+
+        return None
+
+
+def jump_point_search(grid, start, goal, uniform_cost=0.01):
+    """
+    Same as astar(), but jumps across open floor. See JumpPointMap
+    """
+    return JumpPointMap(grid, uniform_cost).find_path(start, goal)
 
-            if neighbor.g > current.g + distance(current.point, neighbor_point) + current.cost:
-                neighbor.g = current.g + distance(current.point, neighbor_point) + current.cost
-                neighbor.parent = current.point
-                open[neighbor_point] = neighbor
 
-    return "Oh no"
+def straight_jumps(states, costs, direction):
+    """
+    Works out a straight jump in one direction from every cell of the map at once. A jump stops at a
+    weighted area or a cell with a forced neighbor.
+    :param states: padded map of cell states, with a blocked border
+    :param costs: padded map of costs
+    :param direction: (row, col) step of the jump
+    :return: map of the flat index each jump ends at, or -index - 1 where it ends at an obstacle,
+    and a running total of the costs along the direction, so the cost of the cells between two points
+    on a line is the difference of their totals
+    """
+    d_row, d_col = direction
+    blocked = states == BLOCKED
+
+    def shifted(mask, row, col):
+        # mask[r + row, c + col] at [r, c]; wraps around, but only border cells see the wrapped values
+        return np.roll(mask, (-row, -col), axis=(0, 1))
+
+    side_row, side_col = abs(d_col), abs(d_row)
+    forced = (shifted(blocked, side_row, side_col) & ~shifted(blocked, side_row + d_row, side_col + d_col)) | \
+             (shifted(blocked, -side_row, -side_col) & ~shifted(blocked, d_row - side_row, d_col - side_col))
+    stop = ((states != UNIFORM) | forced) & ~blocked
+
+    def turn(values):
+        # turns the map so the jump runs along increasing columns
+        if d_row:
+            values = values.T
+        if d_row + d_col < 0:
+            values = values[:, ::-1]
+        return values
+
+    def unturn(values):
+        if d_row + d_col < 0:
+            values = values[:, ::-1]
+        if d_row:
+            values = values.T
+        return values
+
+    stop, blocked = turn(stop), turn(blocked)
+    indices = turn(np.arange(states.size).reshape(states.shape))
+
+    # column of the first stop or obstacle after each cell. The border is blocked, so there always is one
+    columns = np.arange(stop.shape[1])
+    events = np.where(stop | blocked, columns, stop.shape[1] - 1)
+    first = np.minimum.accumulate(events[:, ::-1], axis=1)[:, ::-1]
+    first = np.concatenate([first[:, 1:], first[:, -1:]], axis=1)
+    ends = np.take_along_axis(indices, first, axis=1)
+    ends = np.where(np.take_along_axis(stop, first, axis=1), ends, -ends - 1)
+
+    prefix = np.cumsum(turn(np.where(np.isfinite(costs), costs, 0)), axis=1)
+    return unturn(ends), unturn(prefix)
+
+
+def expand_jumps(index, parents, width, to_point):
+    """
+    Rebuilds the full cell by cell path from a chain of jump points
+    """
+    path = [to_point(index)]
+    while index in parents:
+        parent = parents[index]
+        row, col = divmod(index, width)
+        parent_row, parent_col = divmod(parent, width)
+        d_row = (parent_row > row) - (parent_row < row)
+        d_col = (parent_col > col) - (parent_col < col)
+        while (row, col) != (parent_row, parent_col):
+            row += d_row
+            col += d_col
+            path.append((row - 1, col - 1))
+        index = parent
+    path.reverse()
+    return path
 
 
 if __name__ == '__main__':
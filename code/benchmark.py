@@ -0,0 +1,320 @@
+"""
+Benchmarks for perception and planning, written as JSON so results can be compared between revisions.
+
+Cases:
+    perception    perception_step() per frame over a recorded dataset
+    planners      astar(), D* Lite, jump point search and the hierarchical planner on synthetic and replayed
+                  cost maps of 200x200 and 1000x1000 cells
+    incremental   D* Lite replans from the recorded rover positions as the cost map fills in, repaired
+                  incrementally and from scratch
+    end_to_end    perception_step() + decision_step() throughput, planning synchronously
+
+Example:
+    $ python benchmark.py --output ../output/benchmark.json
+    $ python benchmark.py --quick --compare ../output/benchmark.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from a_star import astar, JumpPointMap
+from costmap import CostMap
+from d_star import DStarNavigator
+from hierarchical import HierarchicalPlanner
+from perception import perception_step
+from replay import read_log, read_image
+from rover_state import RoverState, ground_truth
+import decision
+
+CASES = ('perception', 'planners', 'incremental', 'end_to_end')
+
+
+def timing_stats(seconds):
+    """
+    Summarizes a list of durations in seconds
+    """
+    times = np.array(seconds) * 1000
+    if len(times) == 0:
+        return {'count': 0}
+    return {'count': len(times),
+            'mean_ms': float(times.mean()),
+            'median_ms': float(np.median(times)),
+            'p90_ms': float(np.percentile(times, 90)),
+            'max_ms': float(times.max()),
+            'total_s': float(times.sum() / 1000)}
+
+
+def load_frames(csv_path, limit=None):
+    """
+    Reads the whole dataset into memory first, so disk reads don't count towards any timings
+    """
+    frames = []
+    for image_path, pos, yaw, pitch, roll in read_log(csv_path):
+        frames.append((read_image(image_path), pos, yaw, pitch, roll))
+        if limit is not None and len(frames) >= limit:
+            break
+    return frames
+
+
+def set_pose(rover, frame):
+    rover.img, rover.pos, rover.yaw, rover.pitch, rover.roll = frame
+
+
+def bench_perception(frames, repeat):
+    """
+    :return: results and the worldmap built by the last pass over the frames
+    """
+    times = []
+    for _ in range(repeat):
+        rover = RoverState()
+        for frame in frames:
+            set_pose(rover, frame)
+            start = time.perf_counter()
+            perception_step(rover)
+            times.append(time.perf_counter() - start)
+    stats = timing_stats(times)
+    stats['fps'] = len(times) / stats['total_s']
+    return stats, rover.worldmap
+
+
+def synthetic_obstacles(size, rocks, rng):
+    """
+    Obstacle layer with rectangular rocks of seen obstacle pixels, like a worldmap
+    """
+    obstacles = np.zeros((size, size))
+    for _ in range(rocks):
+        row, col = rng.integers(0, size - 20, 2)
+        height, width = rng.integers(3, 20, 2)
+        obstacles[row:row + height, col:col + width] = rng.integers(20, 200)
+    return obstacles
+
+
+def cost_maps(worldmap, rng):
+    """
+    Returns {name: (costs, mask of cells that can be a start or goal)}
+    """
+    cost_map = CostMap()
+    replayed = cost_map.blur(worldmap[:, :, 0].astype(np.float64))
+    # the same map at five times the resolution, for map sizes the rover doesn't use yet
+    replayed_large = cost_map.blur(cv2.resize(worldmap[:, :, 0].astype(np.float64), (1000, 1000),
+                                              interpolation=cv2.INTER_NEAREST))
+    ground_large = cv2.resize(ground_truth, (1000, 1000), interpolation=cv2.INTER_NEAREST)
+    maps = {'synthetic_200': cost_map.blur(synthetic_obstacles(200, 12, rng)),
+            'synthetic_1000': cost_map.blur(synthetic_obstacles(1000, 300, rng)),
+            'replayed_200': replayed,
+            'replayed_1000': replayed_large}
+    open_cells = {'synthetic_200': None, 'synthetic_1000': None,
+                  'replayed_200': ground_truth > 0, 'replayed_1000': ground_large > 0}
+    return {name: (costs, open_cells[name]) for name, costs in maps.items()}
+
+
+def random_queries(costs, open_cells, count, rng, min_distance):
+    """
+    Returns count (start, goal) pairs of low cost cells at least min_distance apart
+    """
+    candidates = costs < 10
+    if open_cells is not None:
+        candidates &= open_cells
+    cells = np.argwhere(candidates)
+    queries = []
+    while len(queries) < count:
+        start, goal = cells[rng.integers(len(cells), size=2)]
+        if np.hypot(*(start - goal)) >= min_distance:
+            queries.append(((int(start[0]), int(start[1])), (int(goal[0]), int(goal[1]))))
+    return queries
+
+
+def bench_planners(worldmap, queries_per_map, rng):
+    results = {}
+    for name, (costs, open_cells) in cost_maps(worldmap, rng).items():
+        size = costs.shape[0]
+        # D* and astar spend seconds per search on the large maps
+        count = queries_per_map if size <= 200 else max(1, queries_per_map // 4)
+        queries = random_queries(costs, open_cells, count, rng, size / 4)
+
+        start = time.perf_counter()
+        jump_map = JumpPointMap(costs)
+        jump_preprocess = time.perf_counter() - start
+        hierarchical = HierarchicalPlanner()
+        planners = {'astar': lambda s, g: astar(costs, s, g),
+                    'dstar_lite': lambda s, g: DStarNavigator(storage='dense').find_path(s, g, costs),
+                    'jump_point': jump_map.find_path,
+                    'hierarchical': lambda s, g: hierarchical.find_path(costs, s, g)}
+
+        results[name] = {'queries': len(queries), 'jump_point_preprocess_ms': 1000 * jump_preprocess}
+        for planner_name, plan in planners.items():
+            times = []
+            lengths = []
+            for start_point, goal_point in queries:
+                start = time.perf_counter()
+                try:
+                    path = plan(start_point, goal_point)
+                except ValueError:
+                    path = None
+                times.append(time.perf_counter() - start)
+                lengths.append(len(path) if path else 0)
+            results[name][planner_name] = timing_stats(times)
+            results[name][planner_name]['mean_path_length'] = float(np.mean(lengths))
+    return results
+
+
+def bench_incremental(frames, goals):
+    """
+    Drives along the recorded poses while the cost map fills in, and replans to a fixed goal every frame
+    """
+    results = {}
+    for mode in ('incremental', 'from_scratch'):
+        rover = RoverState()
+        cost_map = CostMap()
+        navigator = DStarNavigator(storage='dense', sensing_radius=None)
+        times = []
+        changed_cells = []
+        for index, frame in enumerate(frames):
+            set_pose(rover, frame)
+            perception_step(rover)
+            changed = cost_map.update(rover.worldmap[:, :, 0], rover.obstacle_changes)
+            changed_cells.append(len(changed[0]))
+            start_point = (int(rover.pos[1]), int(rover.pos[0]))
+            goal = goals[index * len(goals) // len(frames)]
+            start = time.perf_counter()
+            if mode == 'from_scratch':
+                navigator.last_goal = None  # forces a fresh search
+            try:
+                navigator.find_path(start_point, goal, cost_map.costs, changed)
+            except ValueError:
+                pass
+            times.append(time.perf_counter() - start)
+        results[mode] = timing_stats(times)
+    results['mean_changed_cells'] = float(np.mean(changed_cells))
+    return results
+
+
+def bench_end_to_end(frames, repeat):
+    times = []
+    # plan synchronously, every new rover gets a fresh navigator, cost map and path cache
+    threaded = decision.navigation_settings['threaded']
+    decision.navigation_settings['threaded'] = False
+    try:
+        for _ in range(repeat):
+            rover = RoverState()
+            rover.vel = 0.5
+            rover.total_time = 0
+            for frame in frames:
+                set_pose(rover, frame)
+                start = time.perf_counter()
+                perception_step(rover)
+                decision.decision_step(rover)
+                times.append(time.perf_counter() - start)
+    finally:
+        decision.navigation_settings['threaded'] = threaded
+    stats = timing_stats(times)
+    stats['fps'] = len(times) / stats['total_s']
+    return stats
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(csv_path, cases=CASES, repeat=3, queries=10, max_frames=None, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = load_frames(csv_path, max_frames)
+    results = {}
+
+    perception_stats, worldmap = bench_perception(frames, repeat)
+    if 'perception' in cases:
+        results['perception'] = perception_stats
+    if 'planners' in cases:
+        results['planners'] = bench_planners(worldmap, queries, rng)
+    if 'incremental' in cases:
+        # goals in the open part of the map, changing a few times over the drive
+        open_cells = np.argwhere(ground_truth > 0)
+        goals = [tuple(int(value) for value in open_cells[rng.integers(len(open_cells))]) for _ in range(4)]
+        results['incremental'] = bench_incremental(frames, goals)
+    if 'end_to_end' in cases:
+        results['end_to_end'] = bench_end_to_end(frames, repeat)
+
+    meta = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'dataset': csv_path,
+            'frames': len(frames), 'repeat': repeat, 'queries': queries, 'seed': seed,
+            'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine()}
+    return {'meta': meta, 'results': results}
+
+
+def flatten(results, prefix=''):
+    """
+    Turns nested results into {'planners.replayed_200.astar.mean_ms': value}
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    """
+    Prints the change in every timing that is in both results. Higher fps is better, the rest are times
+    """
+    old_flat, new_flat = flatten(old['results']), flatten(new['results'])
+    print('{:<55} {:>10} {:>10} {:>8}'.format('metric', 'old', 'new', 'change'))
+    for key in sorted(set(old_flat) & set(new_flat)):
+        if not (key.endswith('_ms') or key.endswith('fps')) or not old_flat[key]:
+            continue
+        change = new_flat[key] / old_flat[key] - 1
+        print('{:<55} {:>10.3f} {:>10.3f} {:>+7.1%}'.format(key, old_flat[key], new_flat[key], change))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark perception and planning')
+    parser.add_argument('csv_path', type=str, nargs='?', default='../test_dataset/robot_log.csv',
+                        help='Path to the robot_log.csv file whose frames are used.')
+    parser.add_argument('--cases', type=str, default=','.join(CASES),
+                        help='Comma separated cases to run, out of ' + ', '.join(CASES) + '.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of passes over the frames for the per-frame cases.')
+    parser.add_argument('--queries', type=int, default=10,
+                        help='Number of start/goal pairs per 200x200 map, a quarter of that on 1000x1000 maps.')
+    parser.add_argument('--max-frames', type=int, default=None,
+                        help='Only use this many frames of the dataset.')
+    parser.add_argument('--quick', action='store_true',
+                        help='One pass, 2 queries per map and 100 frames, for a fast check.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the synthetic maps and the start/goal pairs.')
+    parser.add_argument('--output', type=str, default='',
+                        help='Write the results to this JSON file. They are printed otherwise.')
+    parser.add_argument('--compare', type=str, default='',
+                        help='Results JSON file from an earlier run to compare against.')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.repeat, args.queries, args.max_frames = 1, 2, args.max_frames or 100
+    cases = [case.strip() for case in args.cases.split(',') if case.strip()]
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error('unknown cases: ' + ', '.join(sorted(unknown)))
+
+    results = run(args.csv_path, cases, args.repeat, args.queries, args.max_frames, args.seed)
+    if args.output != '':
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print('Saved results to {}'.format(args.output))
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare != '':
+        with open(args.compare) as compare_file:
+            compare(json.load(compare_file), results)
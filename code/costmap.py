@@ -0,0 +1,53 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+
+class CostMap:
+    """
+    Navigation costs made by blurring the obstacle layer of the worldmap, so that cells near walls cost more.
+    Instead of blurring the whole map every frame, update() only re-blurs the window around the cells
+    that changed. The result is identical to gaussian_filter() over the whole map.
+    """
+
+    def __init__(self, shape=(200, 200), sigma=0.8, truncate=4.0):
+        self.sigma = sigma
+        self.truncate = truncate
+        self.radius = int(truncate * sigma + 0.5)  # same filter radius gaussian_filter uses
+        self.costs = np.zeros(shape, dtype=np.float64)  # blur of an empty map
+
+    def blur(self, obstacles):
+        return gaussian_filter(obstacles, self.sigma, truncate=self.truncate, output=np.float64)
+
+    def update(self, obstacles, changed_cells=None):
+        """
+        Updates the costs after the obstacle layer has changed
+        :param obstacles: obstacle layer of the worldmap
+        :param changed_cells: flat indices of the obstacle cells that changed since the last update,
+        or None to recompute the whole map
+        :return: (rows, cols) of the cost cells that changed
+        """
+        if changed_cells is None:
+            costs = self.blur(obstacles)
+            changed = np.nonzero(costs != self.costs)
+            self.costs[...] = costs
+            return changed
+
+        if len(changed_cells) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        height, width = self.costs.shape
+        rows, cols = np.divmod(changed_cells, width)
+        # every cost within radius of a changed cell can change...
+        top, bottom = max(rows.min() - self.radius, 0), min(rows.max() + self.radius + 1, height)
+        left, right = max(cols.min() - self.radius, 0), min(cols.max() + self.radius + 1, width)
+        # ...and those costs depend on obstacles up to another radius away. Where the window is cut off by
+        # the edge of the map, the filter's reflect mode sees the same thing it would on the whole map
+        in_top, in_bottom = max(top - self.radius, 0), min(bottom + self.radius, height)
+        in_left, in_right = max(left - self.radius, 0), min(right + self.radius, width)
+
+        blurred = self.blur(obstacles[in_top:in_bottom, in_left:in_right])
+        new_costs = blurred[top - in_top:bottom - in_top, left - in_left:right - in_left]
+        old_costs = self.costs[top:bottom, left:right]
+        changed_rows, changed_cols = np.nonzero(new_costs != old_costs)
+        old_costs[...] = new_costs
+        return changed_rows + top, changed_cols + left
@@ -1,159 +1,268 @@
+import logging
 import math
-import heapq
+import numpy as np
+from priority_queue import PriorityQueue
+from grid import get_topology
+from instrumentation import metrics
 
-# based on https://github.com/mdeyo/d-star-lite
+log = logging.getLogger('planner')
+
+# k1 of a key is rounded to this many decimals. It sums g, the heuristic and k_m, which can add up to the same
+# value in different orders and differ in the last bit. Without rounding, a stale cell whose key is one bit
+# larger than the start's sorts after it and the search stops one expansion too early
+KEY_DECIMALS = 9
 
-class Node:
-    def __init__(self, point):
-        self.point = point
-        self.g = math.inf
-        self.rhs = math.inf
+# based on https://github.com/mdeyo/d-star-lite
 
 
-class NodeDict(dict):
+class InfDict(dict):
+    # unvisited points have infinite g and rhs
     def __missing__(self, key):
-        node = Node(key)
-        self.__setitem__(key, node)
-        return node
+        return math.inf
+
+
+class SparseNodes:
+    """
+    Stores g and rhs in dicts keyed by flat index, only for cells the search has touched
+    """
+    def __init__(self, size):
+        self.size = size
+        self.g = InfDict()
+        self.rhs = InfDict()
+
+    def reset(self):
+        self.g.clear()
+        self.rhs.clear()
+
+    def gather_g(self, indices):
+        return np.array([self.g[index] for index in indices.tolist()])
+
+
+class DenseNodes:
+    """
+    Stores g and rhs in preallocated flat arrays with one entry per cell of the cost grid
+    """
+    def __init__(self, size):
+        self.size = size
+        self.g = np.full(size, math.inf)
+        self.rhs = np.full(size, math.inf)
+
+    def reset(self):
+        self.g.fill(math.inf)
+        self.rhs.fill(math.inf)
+
+    def gather_g(self, indices):
+        return self.g[indices]
+
+
+STORAGE = {'sparse': SparseNodes, 'dense': DenseNodes}
 
 
 class DStarNavigator:
-    def __init__(self):
+    def __init__(self, storage='sparse', connectivity=8, sensing_radius=4, max_pending=2000):
+        """
+        :param storage: 'sparse' keeps g/rhs in dicts, 'dense' keeps them in arrays the size of the map.
+        Dense storage is faster and smaller once a search touches a large part of the map
+        :param connectivity: 8 to allow diagonal moves, 4 to only move along rows and columns
+        :param sensing_radius: cost changes within this distance of the start are repaired right away, the
+        rest are kept until the rover gets close to them. None repairs every change right away
+        :param max_pending: once more changes than this are waiting, the search starts over from scratch
+        with the current costs instead
+        """
+        if storage not in STORAGE:
+            raise ValueError('unknown storage ' + str(storage))
+        self.storage = storage
+        self.connectivity = connectivity
+        self.sensing_radius = sensing_radius
+        self.max_pending = max_pending
+        self.topology = None
         self.queue = None
         self.nodes = None
         self.costs = None
-        self.old_costs = None
+        self.flat_costs = None
         self.k_m = 0
         self.start_point = None
         self.goal_point = None
         self.last_goal = None
+        # cells are addressed by flat index internally, see grid.GridTopology
+        self.start = None
+        self.goal = None
+        self.pending = np.zeros(0, dtype=np.int64)  # flat indices of changed cells that haven't been repaired
 
     def initialize(self, start_point, goal_point, costs):
         """
         Wipe away everything and prepare for a new search
         """
-        self.nodes = NodeDict()
-        self.queue = []
-        self.costs = costs
-        self.old_costs = costs
+        self.set_costs(costs)
+        self.topology = get_topology(self.costs.shape, self.connectivity)
+        if self.nodes is not None and self.nodes.size == self.topology.size:
+            self.nodes.reset()
+        else:
+            self.nodes = STORAGE[self.storage](self.topology.size)
+        self.queue = PriorityQueue()
+        self.pending = np.zeros(0, dtype=np.int64)
         self.k_m = 0
         self.start_point = start_point
         self.goal_point = goal_point
         self.last_goal = goal_point
+        self.start = self.topology.to_index(start_point)
+        self.goal = self.topology.to_index(goal_point)
+
+        self.nodes.rhs[self.goal] = 0
+        self.queue.insert(self.goal, self.calculate_key(self.goal))
+
+    def set_costs(self, costs):
+        self.costs = np.ascontiguousarray(costs, dtype=np.float64)
+        self.flat_costs = self.costs.ravel()
 
-        goal = Node(goal_point)
-        goal.rhs = 0
-        self.nodes[goal_point] = goal
-        heapq.heappush(self.queue, (heuristic(goal, start_point), 0) + (goal_point,))
+    def heuristic(self, index):
+        return self.topology.distance(index, self.start)
 
-    def calculate_key(self, point):
-        node = self.nodes[point]
-        return min(node.g, node.rhs) + heuristic(node, self.start_point) + self.k_m, min(node.g, node.rhs)
+    def calculate_key(self, index):
+        g_rhs = min(self.nodes.g[index], self.nodes.rhs[index])
+        return round(g_rhs + self.heuristic(index) + self.k_m, KEY_DECIMALS), g_rhs
 
     def top_key(self):
-        self.queue.sort()
         if len(self.queue) > 0:
-            return self.queue[0][:2]
+            return self.queue.top_key()
         else:
             return math.inf, math.inf
 
-    def travel_cost(self, point1, point2):
-        return self.costs[point2[0]][point2[1]] + distance(point1, point2)
-
-    def get_neighbors(self, point):
-        # return all valid neighbors as (x, y) for a given point
-        points = [(point[0] + 1, point[1]),
-                  (point[0] + 1, point[1] + 1),
-                  (point[0], point[1] + 1),
-                  (point[0] - 1, point[1] + 1),
-                  (point[0] - 1, point[1]),
-                  (point[0] - 1, point[1] - 1),
-                  (point[0], point[1] - 1),
-                  (point[0] + 1, point[1] - 1)]
-        return [p for p in points if (0 <= p[0] < len(self.costs)) and (0 <= p[1] < len(self.costs[0]))]
-
-    def update_vertex(self, vertex_point):
-        vertex = self.nodes[vertex_point]
-        if vertex_point != self.goal_point:
+    def update_vertex(self, index):
+        nodes = self.nodes
+        if index != self.goal:
+            # the cost of moving to a neighbor is the neighbor's cost plus the step length
             min_rhs = math.inf
-            for neighbor in self.get_neighbors(vertex_point):
-                min_rhs = min(min_rhs, self.nodes[neighbor].g + self.travel_cost(vertex_point, neighbor))
-            vertex.rhs = min_rhs
-
-        id_in_queue = [item for item in self.queue if vertex_point == item[2]]
-        if id_in_queue:
-            if len(id_in_queue) != 1:
-                raise ValueError('more than one ' + vertex_point + ' in the queue!')
-            self.queue.remove(id_in_queue[0])
-        if vertex.rhs != vertex.g:
-            heapq.heappush(self.queue, self.calculate_key(vertex_point) + (vertex_point,))
+            g = nodes.g
+            costs = self.flat_costs
+            for offset, step in self.topology.offset_steps(index):
+                neighbor = index + offset
+                rhs = g[neighbor] + costs[neighbor] + step
+                if rhs < min_rhs:
+                    min_rhs = rhs
+            nodes.rhs[index] = min_rhs
+
+        if nodes.rhs[index] != nodes.g[index]:
+            self.queue.insert(index, self.calculate_key(index))
+        else:
+            self.queue.remove(index)
+
+    def update_neighbors(self, index):
+        for offset, _ in self.topology.offset_steps(index):
+            self.update_vertex(index + offset)
 
     def compute_shortest_path(self):
-        while self.top_key() < self.calculate_key(self.start_point) or \
-                        self.nodes[self.start_point].rhs > self.nodes[self.start_point].g:
+        expansions = 0
+        while self.top_key() < self.calculate_key(self.start) or \
+                        self.nodes.rhs[self.start] > self.nodes.g[self.start]:
+            expansions += 1
             k_old = self.top_key()
-            u = heapq.heappop(self.queue)[2]
+            u = self.queue.pop()[1]
             if k_old < self.calculate_key(u):
                 # key has changed, add back into queue
-                heapq.heappush(self.queue, self.calculate_key(u) + (u,))
-            elif self.nodes[u].g > self.nodes[u].rhs:
+                self.queue.insert(u, self.calculate_key(u))
+            elif self.nodes.g[u] > self.nodes.rhs[u]:
                 # rhs is better than existing g, update all parents
-                self.nodes[u].g = self.nodes[u].rhs
-                for neighbor in self.get_neighbors(u):
-                    self.update_vertex(neighbor)
+                self.nodes.g[u] = self.nodes.rhs[u]
+                self.update_neighbors(u)
             else:
-                self.nodes[u].g = math.inf
+                self.nodes.g[u] = math.inf
                 self.update_vertex(u)
-                for neighbor in self.get_neighbors(u):
-                    self.update_vertex(neighbor)
-
-    def update_costs(self, costs):
-        change_x, change_y = (self.costs - costs).nonzero()
-        self.costs = costs
-        for x, y in zip(change_x, change_y):
-            if distance((x,y), self.start_point) < 4 and (x,y) != self.goal_point:
-                self.update_vertex((x,y))
-
-    def extract_path(self):
-        current = self.start_point
+                self.update_neighbors(u)
+
+        metrics.count('dstar_expansions', expansions)
+        metrics.gauge('dstar_queue_size', len(self.queue))
+        metrics.gauge('dstar_pending_changes', len(self.pending))
+
+    def update_costs(self, costs, changed=None):
+        """
+        :param costs: the new cost grid
+        :param changed: boolean mask of the cells whose cost changed, or their (rows, cols). If None, they are
+        found by comparing against the previous costs, which only works if the caller didn't modify the
+        previous array in place
+        """
+        if changed is None:
+            changed = self.costs != costs
+        if isinstance(changed, np.ndarray) and changed.dtype == bool:
+            changed = np.flatnonzero(changed)
+        else:
+            changed = np.ravel_multi_index(changed, self.costs.shape)
+        self.set_costs(costs)
+
+        changed = np.union1d(self.pending, changed)
+        if self.sensing_radius is None:
+            self.pending = changed[:0]
+        else:
+            near = self.topology.distances(changed, self.start_point) < self.sensing_radius
+            changed, self.pending = changed[near], changed[~near]
+            if len(self.pending) > self.max_pending:
+                # too far out of date, a fresh search is cheaper than repairing all of it later
+                self.initialize(self.start_point, self.goal_point, self.costs)
+                return
+        self.repair(changed)
+
+    def repair(self, changed):
+        """
+        Updates the vertices affected by cost changes
+        :param changed: flat indices of the cells whose cost changed
+        """
+        if len(changed) == 0:
+            return
+        # a cell's cost is part of every edge into it, so the rhs of all of its neighbors has to be redone.
+        # Neighbors shared by several changed cells only need it once
+        neighbors, valid = self.topology.neighbor_table(changed)
+        for index in np.unique(neighbors[valid]).tolist():
+            self.update_vertex(index)
+
+    def extract_path(self, max_points=None):
+        """
+        Follows the lowest cost neighbors from start to goal
+        :param max_points: stop after this many points instead of walking all the way to the goal
+        :return: list of (x, y) coordinates, not including the start point
+        """
+        current = self.start
         path = []
-        while current != self.goal_point:
-            min_rhs = math.inf
-            next_point = None
-            for neighbor in self.get_neighbors(current):
-                neighbor_cost = self.nodes[neighbor].g + self.travel_cost(current, neighbor)
-                if neighbor_cost < min_rhs:
-                    min_rhs = neighbor_cost
-                    next_point = neighbor
-            if next_point:
-                path.append(next_point)
-                current = next_point
-            else:
+        visited = {current}
+        while current != self.goal and (max_points is None or len(path) < max_points):
+            # evaluate all neighbors at once and step to the cheapest one
+            neighbors, steps = self.topology.neighbors(current)
+            neighbor_costs = self.nodes.gather_g(neighbors) + self.flat_costs[neighbors] + steps
+            best = np.argmin(neighbor_costs)
+            if not np.isfinite(neighbor_costs[best]):
                 raise ValueError('Could not find path')
+            current = int(neighbors[best])
+            if current in visited:
+                # only happens while some cost changes haven't been repaired
+                raise ValueError('Path goes in circles')
+            visited.add(current)
+            path.append(self.topology.to_point(current))
 
         return path
 
-    def find_path(self, start_point, goal_point, costs):
+    def find_path(self, start_point, goal_point, costs, changed=None, max_points=None):
         if goal_point != self.last_goal:
-            print("\n\n\n New Goal \n\n\n")
+            log.debug('New goal %s', goal_point)
             # starting a new search, wipe everything
             self.initialize(start_point, goal_point, costs)
             self.compute_shortest_path()
         else:
-            self.update_costs(costs)
-            self.k_m += heuristic(self.nodes[self.start_point], start_point)
+            # move the start first, so the sensing radius is measured from where the rover is now
+            self.k_m += self.topology.distance(self.start, self.topology.to_index(start_point))
             self.start_point = start_point
+            self.start = self.topology.to_index(start_point)
+            self.update_costs(costs, changed)
             self.compute_shortest_path()
 
-        return self.extract_path()
-
-
-def heuristic(node, start):
-    return distance(node.point, start)
-
-
-def distance(point1, point2):
-    return math.sqrt((point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2)
+        try:
+            return self.extract_path(max_points)
+        except ValueError:
+            if len(self.pending) == 0:
+                raise
+        # the changes that were put off sent the path the wrong way, repair them now
+        self.repair(self.pending)
+        self.pending = self.pending[:0]
+        self.compute_shortest_path()
+        return self.extract_path(max_points)
 
 
 if __name__ == '__main__':
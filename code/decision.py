@@ -1,9 +1,57 @@
 import numpy as np
 import math
-from scipy.ndimage.filters import gaussian_filter
 from d_star import DStarNavigator
+from costmap import CostMap
+from planner import BackgroundPlanner
+from path_cache import PathCache
+from instrumentation import metrics
 
-navigator = DStarNavigator()
+# settings for the planning state of every new rover, drive_rover.py sets them from the command line
+navigation_settings = {'replan_interval': 0.2, 'max_path_age': 1.0, 'threaded': True, 'sensing_radius': 4,
+                       'max_points': None}
+
+
+class Navigation:
+    """
+    Path planning state of one rover: its cost map, D* navigator, background planner and cached path.
+    Every rover has its own, so several rovers can be driven from one process
+    """
+
+    def __init__(self, replan_interval=0.2, max_path_age=1.0, threaded=True, sensing_radius=4, max_points=None):
+        self.navigator = DStarNavigator(storage='dense', sensing_radius=sensing_radius)
+        self.planner = BackgroundPlanner(self.navigator, replan_interval=replan_interval,
+                                         max_path_age=max_path_age, threaded=threaded, max_points=max_points)
+        self.path_cache = PathCache(max_age=max_path_age)
+        self.cost_map = CostMap()
+        self.cost_changes = []  # (rows, cols) of costs that changed since the navigator last saw them
+
+    def update_cost_map(self, rover):
+        """
+        Brings the cost map up to date with the cells perception changed this frame
+        """
+        rows, cols = self.cost_map.update(rover.worldmap[:, :, 0], rover.obstacle_changes)
+        if len(rows) > 0:
+            self.cost_changes.append((rows, cols))
+
+    def take_cost_changes(self):
+        """
+        Returns all cost changes since the last call as (rows, cols)
+        """
+        if not self.cost_changes:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([change[0] for change in self.cost_changes])
+        cols = np.concatenate([change[1] for change in self.cost_changes])
+        del self.cost_changes[:]
+        return rows, cols
+
+
+def get_navigation(rover):
+    """
+    Returns the rover's planning state, made with navigation_settings on its first decision step
+    """
+    if rover.navigation is None:
+        rover.navigation = Navigation(**navigation_settings)
+    return rover.navigation
 
 
 def steering_angle_between_points(start, end, current_yaw):
@@ -23,34 +71,25 @@ def steering_angle_between_points(start, end, current_yaw):
 
 def get_destination(rover):
     """
-    Returns the (x, y) coordinates of the closest unexplored point.
+    Returns the (x, y) coordinates of the best nearby unexplored point, or None if everything is explored.
     """
 
-    # todo handle when all points are explored
-
-    def manhattan_distance(point):
-        # manhattan distance from rover
-        return abs(point[0] - rover.pos[0]) + abs(point[1] - rover.pos[1])
-
-    def score(point, rover):
-        # returns a score that captures how difficult navigating to the selected point will be
-        # takes into account straight line distance, steering angle, and proximity to walls
-        distance = math.sqrt((point[0] - rover.pos[0]) ** 2 + (point[1] - rover.pos[1]) ** 2)
-        angle = steering_angle_between_points(rover.pos, point, rover.yaw)
-        return distance + abs(angle) / 5 + min(rover.worldmap[point[1], point[0], 0], 30)
+    # get fifty closest points by manhattan distance
+    x_points, y_points = rover.frontier.nearest(rover.pos, 50)
+    if len(x_points) == 0:
+        return None
 
-    y_unexplored, x_unexplored = rover.unexplored.nonzero()
-    unexplored_points = [(x, y) for x, y in zip(x_unexplored, y_unexplored)]
-    unexplored_points.sort(key=manhattan_distance)  # sort by distance from rover
+    # score each point by how difficult navigating to it will be
+    # takes into account straight line distance, steering angle, and proximity to walls
+    x_offsets = x_points - rover.pos[0]
+    y_offsets = y_points - rover.pos[1]
+    distances = np.sqrt(x_offsets ** 2 + y_offsets ** 2)
+    angles = (np.degrees(np.arctan2(y_offsets, x_offsets)) - rover.yaw + 180) % 360 - 180  # between -180 and 180
+    scores = distances + np.abs(angles) / 5 + np.minimum(rover.worldmap[y_points, x_points, 0], 30)
 
-    # get fifty closest points
-    closest_points = unexplored_points[:min(50, len(unexplored_points))]
-
-    # sort again, this time prioritizing points in front of the rover
-    closest_points.sort(key=lambda point: score(point, rover))
-
-    # return best point
-    return closest_points[0]
+    # return best point, prioritizing points in front of the rover
+    best = np.argmin(scores)
+    return int(x_points[best]), int(y_points[best])
 
 
 def get_steer_angle(rover):
@@ -59,10 +98,29 @@ def get_steer_angle(rover):
     :param rover:
     :return:
     """
-    destination = get_destination(rover)
-    costs = gaussian_filter(rover.worldmap[:,:,0], 0.8)
-
-    path = navigator.find_path((int(rover.pos[1]), int(rover.pos[0])), (destination[1], destination[0]), costs)
+    navigation = get_navigation(rover)
+    planner, path_cache, cost_map = navigation.planner, navigation.path_cache, navigation.cost_map
+    # follow the newest finished plan, or keep following the cached one
+    position = (int(rover.pos[1]), int(rover.pos[0]))
+    new_plan = planner.take_new_path()
+    if new_plan is not None:
+        path_cache.set_path(new_plan[0], new_plan[1], cost_map.costs, new_plan[2])
+    path_cache.advance(position)
+
+    with metrics.timer('get_destination'):
+        destination = get_destination(rover)
+    if destination is not None:
+        goal = (destination[1], destination[0])
+        if path_cache.needs_replan(goal, cost_map.costs) and planner.due(goal):
+            # the cost map is updated in place, so tell the navigator which costs changed
+            planner.request_plan(position, goal, cost_map.costs, navigation.take_cost_changes())
+
+    # steer along the cached path without waiting for the planner
+    path = path_cache.path
+    if not path or not path_cache.on_path or path_cache.stale():
+        # nothing to follow yet (or everything has been explored, or the planner has stalled),
+        # just follow the open ground
+        return np.clip(np.mean(rover.nav_angles * 180 / np.pi), -15, 15)
 
     # Uncomment to show navigation path over map
     # rover.worldmap[:, :, 2] = np.zeros_like(rover.worldmap[:, :, 2])
@@ -70,8 +128,8 @@ def get_steer_angle(rover):
     #     rover.worldmap[point[0]][point[1]][1] = 255
     #     rover.worldmap[point[0]][point[1]][2] = 255
 
-    index = min(3, len(path) - 1)  # start a few points away from the current position
-    waypoint = (path[index][1] + 0.5, path[index][0] + 0.5)  # switch xy and try to move to center of square
+    point = path_cache.waypoint(3)  # start a few points away from the current position
+    waypoint = (point[1] + 0.5, point[0] + 0.5)  # switch xy and try to move to center of square
 
     return steering_angle_between_points(rover.pos, waypoint, rover.yaw)
 
@@ -87,6 +145,8 @@ def decision_step(Rover):
     # Example:
     # Check if we have vision data to make decisions with
     if Rover.nav_angles is not None:
+        with metrics.timer('cost_filtering'):
+            get_navigation(Rover).update_cost_map(Rover)
         # Check for Rover.mode status
         if Rover.mode == 'forward': 
             # Check the extent of navigable terrain
@@ -160,7 +220,7 @@ def decision_step(Rover):
     dist = 8
     xpos = int(Rover.pos[0])
     ypos = int(Rover.pos[1])
-    Rover.unexplored[ypos-dist:ypos + dist, xpos-dist:xpos + dist] = 0
+    Rover.frontier.clear(ypos - dist, ypos + dist, xpos - dist, xpos + dist)
         
     # If in a state where want to pickup a rock send pickup command
     if Rover.near_sample and Rover.vel == 0 and not Rover.picking_up:
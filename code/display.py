@@ -0,0 +1,65 @@
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+
+from supporting_functions import create_output_images
+from instrumentation import metrics
+from latest_worker import LatestWorker
+
+
+class DisplayPipeline:
+    """
+    Makes the display images for the simulator on a worker thread, so that control commands never wait
+    for map rendering and JPEG encoding.
+    submit() hands a snapshot of the rover to the worker at most rate times per second, and latest_images()
+    returns the most recently encoded images, which go out with every control command.
+    """
+
+    def __init__(self, rate=5.0, threaded=True):
+        """
+        :param rate: maximum number of display updates per second
+        :param threaded: if False, submit() renders the images before it returns
+        """
+        self.rate = rate
+        self.worker = LatestWorker(self.render, 'display', threaded)  # renders the newest rover snapshot
+        self.lock = threading.Lock()  # guards images
+        self.last_submit_time = -np.inf
+        self.images = ('', '')
+
+    def due(self):
+        return time.time() - self.last_submit_time >= 1.0 / self.rate
+
+    def submit(self, rover):
+        """
+        Queues the rover's current map and vision image for display if it's time for a new update
+        """
+        if not self.due():
+            return
+        self.last_submit_time = time.time()
+        # copy everything perception changes in place, the worker renders while the next frame comes in
+        snapshot = SimpleNamespace(worldmap=rover.worldmap.copy(), vision_image=rover.vision_image.copy(),
+                                   ground_truth=rover.ground_truth, samples_pos=rover.samples_pos,
+                                   samples_located=rover.samples_located,
+                                   samples_found=None if rover.samples_found is None else rover.samples_found.copy(),
+                                   total_time=rover.total_time, samples_collected=rover.samples_collected)
+        self.worker.submit(snapshot)
+
+    def latest_images(self):
+        """
+        Returns the newest (map, vision) base64 JPEG strings, or empty strings before the first update
+        """
+        with self.lock:
+            return self.images
+
+    def render(self, snapshot):
+        with metrics.timer('output_encoding'):
+            images = create_output_images(snapshot)
+        with self.lock:
+            self.images = images
+
+    def stop(self):
+        """
+        Ends the worker thread, e.g. when the rover disconnects. latest_images() keeps returning the last images
+        """
+        self.worker.stop()
@@ -2,87 +2,32 @@
 import argparse
 import shutil
 import base64
-from datetime import datetime
 import os
-import cv2
-import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
+import eventlet.tpool
 from PIL import Image
 from flask import Flask
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
 import time
+import logging
+import atexit
 
 # Import functions for perception and decision making
-from perception import perception_step
-from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+import decision
+from sessions import LocalSessions, ShardedSessions
+from rate_limited_logger import RateLimitedLogger
+from instrumentation import metrics
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = 'forward' # Current mode (can be forward or stop)
-        self.throttle_set = 0.2 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 50 # Threshold to initiate stopping
-        self.go_forward = 500 # Threshold to go forward again
-        self.max_vel = 1.5 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_located = 0 # To store number of samples located on map
-        self.samples_collected = 0 # To count the number of samples collected
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-        self.unexplored = np.zeros_like(ground_truth_3d[:,:,0])
-        self.unexplored[ground_truth_3d[:,:,1] == 255] = 1
-
-
-# Initialize our rover
-Rover = RoverState()
+# One rover per connected simulator, keyed by sid. Replaced by worker processes with --workers
+sessions = LocalSessions()
 
 # Variables to track frames per second (FPS)
 # Intitialize frame counter
@@ -90,6 +35,7 @@ frame_counter = 0
 # Initalize second counter
 second_counter = time.time()
 fps = None
+log = RateLimitedLogger('drive_rover', interval=1.0)
 
 
 # Define telemetry function for what to do with incoming data
@@ -98,71 +44,45 @@ def telemetry(sid, data):
 
     global frame_counter, second_counter, fps
     frame_counter+=1
-    # Do a rough calculation of frames per second (FPS)
+    # Do a rough calculation of frames per second (FPS), over all rovers
     if (time.time() - second_counter) > 1:
         fps = frame_counter
         frame_counter = 0
         second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    log.info('fps', 'Current FPS: %s (%d rovers)', fps, len(sessions))
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
-
-        if np.isfinite(Rover.vel):
-
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
-
-            # The action step!  Send commands to the rover!
- 
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in respose to the current telemetry data.
-
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
-            else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
+        # Update the rover of this connection, run its perception and decision steps
+        # and get the command to send back
+        with metrics.frame():
+            reply = sessions.handle(sid, data)
+
+        # The action step!  Send commands to the rover!
+        if reply[0] == 'pickup':
+            send_pickup(sid)
         else:
-
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
-
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+            _, commands, out_image_string1, out_image_string2 = reply
+            send_control(commands, out_image_string1, out_image_string2, sid)
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        sio.emit('manual', data={}, room=sid)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    send_control((0, 0, 0), '', '', sid)
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        room=sid)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    print("disconnect ", sid)
+    sessions.end(sid)
 
-def send_control(commands, image_string1, image_string2):
+def send_control(commands, image_string1, image_string2, sid):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -171,20 +91,20 @@ def send_control(commands, image_string1, image_string2):
         'inset_image1': image_string1,
         'inset_image2': image_string2,
         }
-    # Send commands via socketIO server
+    # Send commands via socketIO server, only to the rover they are for
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
+def send_pickup(sid):
     print("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -195,7 +115,104 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--replan-rate',
+        type=float,
+        default=5,
+        help='Maximum number of path replans per second towards the same destination.'
+    )
+    parser.add_argument(
+        '--max-path-age',
+        type=float,
+        default=1.0,
+        help='Stop following a path planned from a pose more than this many seconds old, and replan.'
+    )
+    parser.add_argument(
+        '--sensing-radius',
+        type=float,
+        default=4,
+        help='Cost changes within this many cells of the rover are repaired right away, the rest once it gets closer.'
+    )
+    parser.add_argument(
+        '--max-path-points',
+        type=int,
+        default=0,
+        help='Only extract this many points of each planned path, the rover replans at its end. 0 for the whole path.'
+    )
+    parser.add_argument(
+        '--sync-planning',
+        action='store_true',
+        help='Plan paths inside the telemetry handler instead of on a background thread.'
+    )
+    parser.add_argument(
+        '--display-rate',
+        type=float,
+        default=5,
+        help='Maximum number of display image updates per second.'
+    )
+    parser.add_argument(
+        '--sync-display',
+        action='store_true',
+        help='Make display images inside the telemetry handler instead of on a background thread.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='Run the rovers of connected simulators on this many worker processes, 0 to run them in the server. '
+             'Stage timings, the metrics and --profile then only cover whole frames.'
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help='Serve stage latencies and counters as JSON on this local port, e.g. curl localhost:8000.'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        type=str,
+        default='',
+        help='Write stage latencies and counters as JSON to this file every few seconds.'
+    )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default='',
+        help='Run cProfile on the telemetry handler and save the stats to this file, for pstats or snakeviz.'
+    )
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        default='INFO',
+        help='Logging level for the rate limited telemetry and FPS messages, e.g. DEBUG or WARNING.'
+    )
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s: %(message)s')
+
+    # configure the background planner of every rover
+    decision.navigation_settings.update(replan_interval=1.0 / args.replan_rate, max_path_age=args.max_path_age,
+                                        threaded=not args.sync_planning, sensing_radius=args.sensing_radius,
+                                        max_points=args.max_path_points or None)
+
+    # configure the display pipeline of every rover
+    session_args = dict(display_rate=args.display_rate, display_threaded=not args.sync_display,
+                        image_folder=args.image_folder)
+    if args.workers > 0:
+        # wait for the workers on a real thread, so the other rovers are served meanwhile
+        sessions = ShardedSessions(args.workers, wait=lambda future: eventlet.tpool.execute(future.result),
+                                   log_level=args.log_level.upper(), **session_args)
+        atexit.register(sessions.shutdown)
+    else:
+        sessions = LocalSessions(**session_args)
+
+    # performance data, see instrumentation.py
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file != '':
+        metrics.write_periodically(args.metrics_file)
+    if args.profile != '':
+        metrics.enable_profiling(args.profile)
+        atexit.register(metrics.dump_profile)
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class FrontierIndex:
+    """
+    Bucket grid over the unexplored mask, for finding the unexplored cells closest to the rover without
+    scanning the whole map. Each bucket is bucket_size x bucket_size cells and keeps a count of its
+    unexplored cells, so empty buckets are skipped and buckets are searched nearest first.
+    """
+
+    def __init__(self, unexplored, bucket_size=16):
+        """
+        :param unexplored: map that is nonzero for unexplored cells. It is cleared in place by clear()
+        """
+        self.unexplored = unexplored
+        self.bucket_size = bucket_size
+        height, width = unexplored.shape
+        self.rows = -(-height // bucket_size)
+        self.cols = -(-width // bucket_size)
+        self.counts = np.zeros((self.rows, self.cols), dtype=np.int64)
+        for row in range(self.rows):
+            for col in range(self.cols):
+                self.count_bucket(row, col)
+
+        # cell bounds of every bucket, used for distance lower bounds
+        bucket_rows, bucket_cols = np.indices((self.rows, self.cols))
+        self.top = bucket_rows * bucket_size
+        self.bottom = np.minimum(self.top + bucket_size, height) - 1
+        self.left = bucket_cols * bucket_size
+        self.right = np.minimum(self.left + bucket_size, width) - 1
+
+    def bucket_slices(self, row, col):
+        size = self.bucket_size
+        return slice(row * size, (row + 1) * size), slice(col * size, (col + 1) * size)
+
+    def count_bucket(self, row, col):
+        self.counts[row, col] = np.count_nonzero(self.unexplored[self.bucket_slices(row, col)])
+
+    def clear(self, top, bottom, left, right):
+        """
+        Marks the cells in rows top:bottom and columns left:right as explored. Bounds are clipped to the map
+        """
+        height, width = self.unexplored.shape
+        top, bottom = max(top, 0), min(bottom, height)
+        left, right = max(left, 0), min(right, width)
+        if top >= bottom or left >= right:
+            return
+        self.unexplored[top:bottom, left:right] = 0
+        for row in range(top // self.bucket_size, (bottom - 1) // self.bucket_size + 1):
+            for col in range(left // self.bucket_size, (right - 1) // self.bucket_size + 1):
+                self.count_bucket(row, col)
+
+    def nearest(self, pos, k):
+        """
+        Returns the k unexplored cells with the smallest manhattan distance to pos, closest first.
+        Ties are ordered by row, then column
+        :param pos: (x, y) position
+        :return: (x, y) arrays of cell coordinates
+        """
+        x, y = pos
+        # manhattan distance from pos to the closest cell of each bucket
+        bounds = np.maximum(np.maximum(self.left - x, x - self.right), 0) + \
+                 np.maximum(np.maximum(self.top - y, y - self.bottom), 0)
+        occupied = np.flatnonzero(self.counts)
+        occupied = occupied[np.argsort(bounds.ravel()[occupied], kind='stable')]
+
+        ys, xs = [], []
+        found = 0
+        kth_distance = np.inf
+        for bucket in occupied:
+            # buckets are sorted by lower bound, once it passes the kth best distance nothing closer is left
+            if found >= k and bounds.flat[bucket] > kth_distance:
+                break
+            row_slice, col_slice = self.bucket_slices(*divmod(bucket, self.cols))
+            bucket_ys, bucket_xs = self.unexplored[row_slice, col_slice].nonzero()
+            ys.append(bucket_ys + row_slice.start)
+            xs.append(bucket_xs + col_slice.start)
+            found += len(bucket_ys)
+            if found >= k:
+                distances = np.abs(np.concatenate(xs) - x) + np.abs(np.concatenate(ys) - y)
+                kth_distance = np.partition(distances, k - 1)[k - 1]
+
+        if not found:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        xs = np.concatenate(xs)
+        ys = np.concatenate(ys)
+        distances = np.abs(xs - x) + np.abs(ys - y)
+        order = np.lexsort((xs, ys, distances))[:k]
+        return xs[order], ys[order]
@@ -0,0 +1,93 @@
+import math
+from functools import lru_cache
+import numpy as np
+
+# (row, col) offsets in the order the planners have always visited neighbors
+EIGHT_CONNECTED = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+FOUR_CONNECTED = ((1, 0), (0, 1), (-1, 0), (0, -1))
+
+
+class GridTopology:
+    """
+    Precomputed neighbor tables for a grid whose cells are addressed by flat index row * width + col.
+    The neighbors of a cell are index + flat_offsets, masked by the cell's row in valid so that
+    nothing wraps around or falls off the edge of the grid.
+
+    neighbors() and neighbor_table() evaluate all neighbors at once with NumPy. Per-cell numpy calls cost
+    more than a short python loop, so the planners' inner loops walk offset_steps() instead, which
+    needs no bounds checks away from the border.
+    """
+
+    def __init__(self, shape, connectivity=8):
+        if connectivity == 8:
+            offsets = EIGHT_CONNECTED
+        elif connectivity == 4:
+            offsets = FOUR_CONNECTED
+        else:
+            raise ValueError('connectivity must be 4 or 8, not ' + str(connectivity))
+
+        self.shape = shape
+        self.height, self.width = shape
+        self.size = self.height * self.width
+        self.connectivity = connectivity
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.flat_offsets = self.offsets[:, 0] * self.width + self.offsets[:, 1]
+        self.step_costs = np.hypot(self.offsets[:, 0], self.offsets[:, 1])
+
+        # border masks, one row of booleans per cell
+        rows, cols = np.divmod(np.arange(self.size), self.width)
+        neighbor_rows = rows[:, None] + self.offsets[:, 0]
+        neighbor_cols = cols[:, None] + self.offsets[:, 1]
+        self.valid = (neighbor_rows >= 0) & (neighbor_rows < self.height) & \
+                     (neighbor_cols >= 0) & (neighbor_cols < self.width)
+        self.interior = self.valid.all(axis=1)
+        self.all_offset_steps = tuple(zip(self.flat_offsets.tolist(), self.step_costs.tolist()))
+
+    def to_index(self, point):
+        return int(point[0]) * self.width + int(point[1])
+
+    def to_point(self, index):
+        return divmod(int(index), self.width)
+
+    def offset_steps(self, index):
+        """
+        Returns (flat offset, step cost) pairs for every neighbor of a cell that is inside the grid
+        """
+        if self.interior[index]:
+            return self.all_offset_steps
+        return [pair for pair, valid in zip(self.all_offset_steps, self.valid[index]) if valid]
+
+    def neighbors(self, index):
+        """
+        Returns the flat indices of all neighbors of a cell and the step cost to each of them
+        """
+        valid = self.valid[index]
+        return index + self.flat_offsets[valid], self.step_costs[valid]
+
+    def neighbor_table(self, indices):
+        """
+        Returns an (n, connectivity) array of neighbor indices for many cells at once and the matching
+        border mask. Entries where the mask is False are not valid cells.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return indices[:, None] + self.flat_offsets, self.valid[indices]
+
+    def distance(self, index1, index2):
+        row1, col1 = divmod(int(index1), self.width)
+        row2, col2 = divmod(int(index2), self.width)
+        return math.sqrt((row1 - row2) ** 2 + (col1 - col2) ** 2)
+
+    def distances(self, indices, point):
+        """
+        Returns the straight line distance from each of the given cells to a single (row, col) point
+        """
+        rows, cols = np.divmod(indices, self.width)
+        return np.hypot(rows - point[0], cols - point[1])
+
+
+@lru_cache(maxsize=8)
+def get_topology(shape, connectivity=8):
+    """
+    Returns a shared GridTopology, so that repeated searches on the same map size don't rebuild the tables
+    """
+    return GridTopology(tuple(shape), connectivity)
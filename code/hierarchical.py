@@ -0,0 +1,101 @@
+import numpy as np
+from scipy.ndimage import binary_dilation
+from a_star import astar
+
+
+class HierarchicalPlanner:
+    """
+    HPA*-style two level planner for large maps.
+    The cost grid is pooled into blocks of block_size x block_size cells and searched at that coarse
+    resolution first. The fine planner then only searches a corridor of blocks around the coarse path,
+    so the number of expanded cells grows with the length of the route instead of the size of the map.
+    If the corridor turns out to be blocked, it falls back to a fine search of the whole map.
+    """
+
+    def __init__(self, block_size=8, corridor=1, pooling='mean', fine_planner=astar):
+        """
+        :param block_size: side length of a coarse block in cells
+        :param corridor: number of blocks around the coarse path that the fine search may use
+        :param pooling: 'mean' or 'max' of the passable costs in a block. A block with no passable cells
+        is an obstacle at the coarse level
+        :param fine_planner: function(grid, start, goal) that returns a list of points from start to goal,
+        or None if there is no path. Non-finite costs must be treated as obstacles
+        """
+        if pooling not in ('mean', 'max'):
+            raise ValueError('unknown pooling ' + str(pooling))
+        self.block_size = block_size
+        self.corridor = corridor
+        self.pooling = pooling
+        self.fine_planner = fine_planner
+
+    def coarse_costs(self, costs):
+        """
+        Returns the pooled cost of every block. Partial blocks at the edge of the map are pooled over
+        the cells they have
+        """
+        size = self.block_size
+        height, width = costs.shape
+        rows, cols = -(-height // size), -(-width // size)
+        padded = np.full((rows * size, cols * size), np.nan)
+        padded[:height, :width] = np.where(np.isfinite(costs), costs, np.nan)
+        blocks = padded.reshape(rows, size, cols, size)
+        passable = np.isfinite(blocks).any(axis=(1, 3))
+
+        pooled = np.full((rows, cols), np.inf)
+        blocks = blocks[passable.nonzero()[0], :, passable.nonzero()[1], :]
+        if self.pooling == 'mean':
+            pooled[passable] = np.nanmean(blocks, axis=(1, 2))
+        else:
+            pooled[passable] = np.nanmax(blocks, axis=(1, 2))
+        return pooled
+
+    def corridor_mask(self, coarse_path, coarse_shape, shape):
+        """
+        Returns a mask of the fine cells within corridor blocks of the coarse path
+        """
+        coarse_mask = np.zeros(coarse_shape, dtype=bool)
+        rows, cols = zip(*coarse_path)
+        coarse_mask[list(rows), list(cols)] = True
+        if self.corridor > 0:
+            coarse_mask = binary_dilation(coarse_mask, structure=np.ones((3, 3), dtype=bool),
+                                          iterations=self.corridor)
+        mask = np.repeat(np.repeat(coarse_mask, self.block_size, axis=0), self.block_size, axis=1)
+        return mask[:shape[0], :shape[1]]
+
+    def find_path(self, grid, start, goal):
+        """
+        Given a matrix of costs and start/end points, find a near-optimal path.
+        :param grid: np matrix of costs for each square, non-finite costs are obstacles
+        :param start: (x, y) tuple coordinates of start point
+        :param goal: (x, y) tuple coordinates of end point
+        :return: list of (x, y) coordinates that define the path from start to goal, or None if there is no path
+        """
+        costs = np.asarray(grid, dtype=np.float64)
+        size = self.block_size
+        coarse = self.coarse_costs(costs)
+        coarse_start = (start[0] // size, start[1] // size)
+        coarse_goal = (goal[0] // size, goal[1] // size)
+        coarse[coarse_start] = min(coarse[coarse_start], 10)  # the start or goal block may look blocked
+        coarse[coarse_goal] = min(coarse[coarse_goal], 10)
+
+        coarse_path = astar(coarse, coarse_start, coarse_goal)
+        if coarse_path is not None:
+            path = self.refine(costs, coarse_path, coarse.shape, start, goal)
+            if path is not None:
+                return path
+        # the coarse level can be wrong about narrow passages, so make sure with a full search
+        return self.fine_planner(costs, start, goal)
+
+    def refine(self, costs, coarse_path, coarse_shape, start, goal):
+        """
+        Runs the fine planner on the part of the map inside the corridor around the coarse path
+        """
+        mask = self.corridor_mask(coarse_path, coarse_shape, costs.shape)
+        rows, cols = mask.nonzero()
+        top, bottom, left, right = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+
+        window = np.where(mask[top:bottom, left:right], costs[top:bottom, left:right], np.inf)
+        path = self.fine_planner(window, (start[0] - top, start[1] - left), (goal[0] - top, goal[1] - left))
+        if path is None:
+            return None
+        return [(int(row + top), int(col + left)) for row, col in path]
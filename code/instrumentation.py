@@ -0,0 +1,254 @@
+"""
+Latency histograms, counters and an optional profiler for the telemetry pipeline.
+
+Stages are timed with the shared metrics object:
+
+    with metrics.timer('perspective_transform'):
+        ...
+
+drive_rover.py times each telemetry frame with a metrics.frame() block, which also keeps a breakdown of
+where the time went in the slowest recent frames. summary() returns everything as a dict that can be
+served over HTTP with serve() or written to a file every few seconds with write_periodically().
+"""
+import bisect
+import contextvars
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# histogram bucket upper bounds in seconds, four per decade from 10 us to 10 s
+BUCKET_BOUNDS = tuple(float(bound) for bound in np.logspace(-5, 1, 25))
+
+
+class Histogram:
+    """
+    Counts durations in logarithmic buckets, which is enough for percentiles to within a bucket
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)  # the last bucket holds everything above 10 s
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket that holds the given percentile, in seconds
+        """
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        # in milliseconds, which is easier to read for the stages of a frame
+        return {'count': self.count,
+                'mean_ms': 1000 * self.total / self.count if self.count else 0.0,
+                'p50_ms': 1000 * self.percentile(50),
+                'p90_ms': 1000 * self.percentile(90),
+                'p99_ms': 1000 * self.percentile(99),
+                'max_ms': 1000 * self.max}
+
+
+class Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+# frame in progress in the current thread or greenthread, which the stages it runs are added to.
+# Each greenlet has its own context, so frames of several rovers served by eventlet don't mix
+current_frame = contextvars.ContextVar('current_frame', default=None)
+
+
+class Frame:
+    """
+    Times one telemetry frame and collects the times of the stages that run inside it
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.stages = {}
+        self.start = 0.0
+        self.token = None
+
+    def __enter__(self):
+        self.token = current_frame.set(self)
+        self.metrics.profile_start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.profile_stop()
+        current_frame.reset(self.token)
+        self.metrics.end_frame(elapsed, self.stages)
+        return False
+
+
+class Metrics:
+    """
+    Thread safe store of stage latencies, counters and gauges
+    """
+
+    def __init__(self, slow_frame=0.1, slow_frames_kept=20):
+        """
+        :param slow_frame: frames that take longer than this many seconds keep their stage breakdown
+        :param slow_frames_kept: number of slow frame breakdowns to keep
+        """
+        self.slow_frame = slow_frame
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}  # name: (last value, max value)
+        self.slow_frames = deque(maxlen=slow_frames_kept)
+        self.frames = 0
+        self.active_frames = 0  # frames in progress, the profiler runs while there are any
+        self.profiler = None
+        self.profile_path = None
+        self.profile_every = 0
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].add(seconds)
+        frame = current_frame.get()
+        if frame is not None:
+            frame.stages[stage] = frame.stages.get(stage, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            _, high = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(high, value))
+
+    def frame(self):
+        """
+        Returns a context manager that times one frame:
+
+            with metrics.frame():
+                ...
+
+        Stages timed inside the block count towards the frame's breakdown, also when other frames run
+        concurrently in other threads or greenthreads
+        """
+        return Frame(self)
+
+    def end_frame(self, elapsed, stages):
+        self.record('frame', elapsed)
+        with self.lock:
+            self.frames += 1
+            if elapsed > self.slow_frame:
+                stages = {stage: round(1000 * seconds, 3) for stage, seconds in stages.items()}
+                self.slow_frames.append({'frame': self.frames, 'time': time.time(),
+                                         'total_ms': round(1000 * elapsed, 3), 'stages_ms': stages})
+            dump = self.profiler is not None and self.frames % self.profile_every == 0
+        if dump:
+            self.dump_profile()
+
+    def profile_start(self):
+        with self.lock:
+            self.active_frames += 1
+            if self.profiler is not None and self.active_frames == 1:
+                self.profiler.enable()
+
+    def profile_stop(self):
+        with self.lock:
+            self.active_frames -= 1
+            if self.profiler is not None and self.active_frames == 0:
+                self.profiler.disable()
+
+    def summary(self):
+        with self.lock:
+            return {'frames': self.frames,
+                    'stages': {stage: histogram.summary() for stage, histogram in self.stages.items()},
+                    'counters': dict(self.counters),
+                    'gauges': {name: {'last': last, 'max': high} for name, (last, high) in self.gauges.items()},
+                    'slow_frames': list(self.slow_frames)}
+
+    def enable_profiling(self, path, every=500):
+        """
+        Runs cProfile while any frame of the telemetry handler is in progress and writes the stats to path,
+        which can be read with pstats or snakeviz. Only the handler's thread is profiled
+        :param every: write the stats again after this many frames
+        """
+        self.profiler = cProfile.Profile()
+        self.profile_path = path
+        self.profile_every = every
+
+    def dump_profile(self):
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves summary() as JSON over HTTP on a background thread, e.g. curl localhost:port
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.summary(), indent=2).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # don't print a line for every request
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+    def write_periodically(self, path, interval=5.0):
+        """
+        Writes summary() as JSON to path every interval seconds on a background thread
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                # write next to the file and swap it in, so readers never see half a summary
+                with open(path + '.tmp', 'w') as summary_file:
+                    json.dump(self.summary(), summary_file, indent=2)
+                os.replace(path + '.tmp', path)
+
+        threading.Thread(target=run, name='metrics-file', daemon=True).start()
+
+
+# shared by every module that records timings
+metrics = Metrics()
@@ -0,0 +1,67 @@
+import logging
+import threading
+
+log = logging.getLogger('latest_worker')
+
+
+class LatestWorker:
+    """
+    Handles submitted items on a worker thread, keeping only the newest one that hasn't been started yet,
+    so the worker always works on the freshest data instead of a backlog.
+    The thread is started by the first submit(). An exception from the handler is logged and the worker
+    carries on with the next item
+    """
+
+    def __init__(self, handle, name, threaded=True, merge=None):
+        """
+        :param handle: function called with every item that is handled
+        :param name: name of the worker thread, also used in log messages
+        :param threaded: if False, items are handled immediately in submit(), e.g. for offline replays
+        :param merge: function(older, newer) returning the item to keep when an item is replaced before it
+        was handled, e.g. to keep data from both. Only the newer item is kept by default
+        """
+        self.handle = handle
+        self.name = name
+        self.threaded = threaded
+        self.merge = merge
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        self.item = None  # newest item that hasn't been handled yet
+
+    def submit(self, item):
+        if not self.threaded:
+            self.handle(item)
+            return
+
+        with self.condition:
+            if self.item is not None and self.merge is not None:
+                item = self.merge(self.item, item)
+            self.item = item
+            self.condition.notify()
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Ends the worker thread after the item in progress. An item that hasn't been started is dropped
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.item is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                item = self.item
+                self.item = None
+            try:
+                self.handle(item)
+            except Exception:
+                log.exception('%s worker failed', self.name)
@@ -0,0 +1,96 @@
+import time
+import numpy as np
+
+
+class PathCache:
+    """
+    Keeps the last planned path between frames so the rover can keep following it without replanning.
+    A cursor marks the path point closest to the rover and moves forward as the rover drives.
+    needs_replan() says when the path can't be trusted anymore: the goal changed, the rover left the
+    corridor around the path, it reached the end of the path, the costs along the rest of the path
+    changed by more than cost_threshold since it was planned, or it was planned more than max_age
+    seconds ago.
+    """
+
+    def __init__(self, corridor=2.0, cost_threshold=20.0, search_window=10, max_age=1.0):
+        """
+        :param corridor: the rover has left the path when it is further than this many cells from it
+        :param cost_threshold: total change in the costs of the remaining path points that triggers a replan
+        :param search_window: number of points ahead of the cursor to look for the rover's position
+        :param max_age: a path planned this many seconds ago is stale, e.g. because the planner stalled
+        """
+        self.corridor = corridor
+        self.cost_threshold = cost_threshold
+        self.search_window = search_window
+        self.max_age = max_age
+        self.clear()
+
+    def clear(self):
+        self.path = None
+        self.goal = None
+        self.rows = None
+        self.cols = None
+        self.path_costs = None
+        self.planned_time = -np.inf
+        self.cursor = 0
+        self.on_path = False
+
+    def set_path(self, path, goal, costs, planned_time):
+        """
+        Starts following a new path
+        :param path: list of (row, col) points, not including the rover's position
+        :param goal: (row, col) the path was planned to
+        :param costs: current cost map, the path is replanned when these costs change too much
+        :param planned_time: time.time() of the pose and costs the path was planned from
+        """
+        if not path:
+            self.clear()
+            return
+        self.path = path
+        self.goal = goal
+        self.planned_time = planned_time
+        self.rows, self.cols = (np.array(values) for values in zip(*path))
+        self.path_costs = costs[self.rows, self.cols]
+        self.cursor = 0
+        self.on_path = True
+
+    def advance(self, position):
+        """
+        Moves the cursor to the path point closest to the rover, looking a few points ahead of the cursor
+        :param position: (row, col) of the rover
+        :return: True if the rover is still within the corridor around the path
+        """
+        if self.path is None:
+            return False
+        end = min(self.cursor + self.search_window, len(self.path))
+        distances = np.hypot(self.rows[self.cursor:end] - position[0], self.cols[self.cursor:end] - position[1])
+        nearest = int(np.argmin(distances))
+        self.cursor += nearest
+        self.on_path = distances[nearest] <= self.corridor
+        return self.on_path
+
+    def costs_changed(self, costs):
+        """
+        Returns true if the costs of the path points ahead of the cursor changed by more than cost_threshold
+        """
+        remaining = slice(self.cursor, None)
+        changes = np.abs(costs[self.rows[remaining], self.cols[remaining]] - self.path_costs[remaining])
+        # a cell that became an obstacle gives an infinite change, inf - inf is nan
+        return np.nansum(changes) > self.cost_threshold
+
+    def stale(self):
+        return time.time() - self.planned_time > self.max_age
+
+    def needs_replan(self, goal, costs):
+        if self.path is None or goal != self.goal or not self.on_path or self.stale():
+            return True
+        if self.cursor >= len(self.path) - 1:
+            # reached the end, either the goal or the last point of a shortened path
+            return True
+        return self.costs_changed(costs)
+
+    def waypoint(self, lookahead=3):
+        """
+        Returns the path point lookahead points past the cursor, or the last point if the path is shorter
+        """
+        return self.path[min(self.cursor + lookahead, len(self.path) - 1)]
@@ -1,5 +1,7 @@
+from functools import lru_cache
 import numpy as np
 import cv2
+from instrumentation import metrics
 
 
 # Identify pixels above the threshold
@@ -34,6 +36,43 @@ def trim(binary_img):
     return binary_img
 
 
+# Preallocated navigable/obstacle/sample masks, filled in by classify()
+class ThresholdMasks:
+    def __init__(self, shape=(160, 320), trim_size=80):
+        self.navigable = np.zeros(shape, dtype=np.uint8)
+        self.obstacle = np.zeros(shape, dtype=np.uint8)
+        self.sample = np.zeros(shape, dtype=np.uint8)
+        # only the region that survives trim() is ever written, everything outside it stays 0
+        self.roi = (slice(trim_size, None), slice(trim_size, shape[1] - trim_size))
+        roi_shape = (shape[0] - trim_size, shape[1] - 2 * trim_size)
+        self.navigable_raw = np.zeros(roi_shape, dtype=np.uint8)
+        self.hidden_raw = np.zeros(roi_shape, dtype=np.uint8)
+        self.sample_raw = np.zeros(roi_shape, dtype=np.uint8)
+        self.hsv = np.zeros(roi_shape + (3,), dtype=np.uint8)
+
+
+# Produces the same masks as trim(get_navigable()), trim(get_obstacle()) and trim(hsv_thresh())
+# in one pass over the trimmed region, without allocating new images.
+# img can be the whole warped image or just its masks.roi region
+def classify(img, masks, rgb_thresh=(160, 160, 160), low=(15, 80, 130), high=(30, 255, 180)):
+    roi = img[masks.roi] if img.shape[:2] == masks.navigable.shape else img
+
+    # inRange marks matching pixels with 255, & 1 turns that into the 0/1 masks the rest of the code expects
+    navigable = cv2.inRange(roi, tuple(t + 1 for t in rgb_thresh), (255, 255, 255), dst=masks.navigable_raw)
+    np.bitwise_and(navigable, 1, out=masks.navigable[masks.roi])
+
+    # obstacles are everything that is neither navigable nor [0,0,0] (not visible to the camera)
+    hidden = cv2.inRange(roi, (0, 0, 0), (0, 0, 0), dst=masks.hidden_raw)
+    hidden = cv2.bitwise_or(hidden, navigable, dst=hidden)
+    np.equal(hidden, 0, out=masks.obstacle[masks.roi])
+
+    hsv = cv2.cvtColor(roi, cv2.COLOR_RGB2HSV, dst=masks.hsv)
+    sample = cv2.inRange(hsv, low, high, dst=masks.sample_raw)
+    np.bitwise_and(sample, 1, out=masks.sample[masks.roi])
+
+    return masks.navigable, masks.obstacle, masks.sample
+
+
 def get_navigable(img, rgb_thresh=(160, 160, 160)):
     return color_thresh(img, rgb_thresh)
 
@@ -58,8 +97,8 @@ def rover_coords(binary_img):
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[1] / 2).astype(np.float)
+    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float64)
+    y_pixel = -(xpos - binary_img.shape[1] / 2).astype(np.float64)
     return x_pixel, y_pixel
 
 
@@ -74,6 +113,26 @@ def to_polar_coords(x_pixel, y_pixel):
     return dist, angles
 
 
+# Lookup tables from flat pixel index (row * width + col) to rover coords and polar coords.
+# The camera geometry never changes, so these are built once per image shape by get_coord_table()
+class RoverCoordTable:
+    def __init__(self, shape):
+        x_pixel, y_pixel = rover_coords(np.ones(shape, dtype=np.uint8))
+        dist, angles = to_polar_coords(x_pixel, y_pixel)
+        self.shape = shape
+        self.x = x_pixel.astype(np.float32)
+        self.y = y_pixel.astype(np.float32)
+        self.dist = dist.astype(np.float32)
+        self.angle = angles.astype(np.float32)
+        # homogeneous (x, y, 1) columns, ready to multiply by a 2x3 affine transform
+        self.xy1 = np.stack([self.x, self.y, np.ones_like(self.x)])
+
+
+@lru_cache(maxsize=4)
+def get_coord_table(shape):
+    return RoverCoordTable(tuple(shape))
+
+
 # Define a function to map rover space pixels to world space
 def rotate_pix(xpix, ypix, yaw):
     # Convert yaw to radians
@@ -115,20 +174,134 @@ def image_to_world(binary_img, xpos, ypos, yaw, worldsize, scale):
     return pix_to_world(xpix, ypix, xpos, ypos, yaw, worldsize, scale)
 
 
+# Calibration points for the perspective transform, measured on calibration_images/example_grid1.jpg.
+# These four points in the camera image map to a square of 2 * dst_size pixels on a side,
+# bottom_offset pixels above the bottom center of the warped image
+CALIBRATION_SOURCE = ((7, 146), (313, 146), (200, 97), (120, 97))
+CALIBRATION_DST_SIZE = 5
+CALIBRATION_BOTTOM_OFFSET = 6
+
+
+# Perspective transform that computes its matrix once per image shape and warps into a reusable buffer
+class PerspectiveTransform:
+    def __init__(self, source=CALIBRATION_SOURCE, dst_size=CALIBRATION_DST_SIZE,
+                 bottom_offset=CALIBRATION_BOTTOM_OFFSET, use_remap=False, region_warp=False):
+        """
+        :param source: four (x, y) calibration points in the camera image
+        :param dst_size: half the side length of the calibration square in the warped image
+        :param bottom_offset: distance in pixels from the calibration square to the bottom of the warped image
+        :param use_remap: warp with precomputed cv2.remap tables instead of cv2.warpPerspective, which is
+        slightly faster. The output is not bit for bit the same: about 0.02% of pixels differ by one intensity
+        level with OpenCV 5, which changed 4 mask pixels over the 283 test_dataset frames. OpenCV versions
+        whose warpPerspective rounds its lookups to fixed point can differ more
+        :param region_warp: let perception_step() warp only the region that classify() reads, with a shifted
+        matrix, which is faster. The shifted matrix rounds differently from a cropped full frame warp: over the
+        283 test_dataset frames it changes 955 channel values and 8 mask pixels. Off by default, so the masks
+        stay identical to the original pipeline
+        """
+        self.source = np.float32(source)
+        self.dst_size = dst_size
+        self.bottom_offset = bottom_offset
+        self.use_remap = use_remap
+        self.region_warp = region_warp
+        self.matrices = {}  # (shape, region) -> M
+        self.maps = {}  # (shape, region) -> remap tables
+        self.buffer = None
+
+    def matrix(self, shape, region=None):
+        """
+        Returns the transform matrix for images of the given shape. If region is a (row slice, col slice)
+        of the warped image, the matrix only produces that part of the output
+        """
+        key = (shape[:2], region_bounds(shape, region))
+        if key not in self.matrices:
+            height, width = shape[:2]
+            dst_size = self.dst_size
+            bottom_offset = self.bottom_offset
+            destination = np.float32([[width / 2 - dst_size, height - bottom_offset],
+                                      [width / 2 + dst_size, height - bottom_offset],
+                                      [width / 2 + dst_size, height - 2 * dst_size - bottom_offset],
+                                      [width / 2 - dst_size, height - 2 * dst_size - bottom_offset],
+                                      ])
+            M = cv2.getPerspectiveTransform(self.source, destination)
+            top, _, left, _ = key[1]
+            if top or left:
+                # shift the output so the region starts at (0, 0)
+                M = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype=np.float64) @ M
+            self.matrices[key] = M
+        return self.matrices[key]
+
+    def remap_tables(self, shape, region=None):
+        key = (shape[:2], region_bounds(shape, region))
+        if key not in self.maps:
+            # like cv2.initUndistortRectifyMap: for every output pixel, look up where it comes from in the input.
+            # The lookups are computed in double precision from the same matrix warpPerspective gets, and kept
+            # as float maps, because warpPerspective interpolates at float positions too
+            top, bottom, left, right = key[1]
+            inverse = np.linalg.inv(self.matrix(shape, region))
+            ys, xs = np.indices((bottom - top, right - left), dtype=np.float64)
+            w = inverse[2, 0] * xs + inverse[2, 1] * ys + inverse[2, 2]
+            map_x = (inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]) / w
+            map_y = (inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]) / w
+            self.maps[key] = (map_x.astype(np.float32), map_y.astype(np.float32))
+        return self.maps[key]
+
+    def warp(self, image, out=None, region=None):
+        """
+        Warps image to a top down view. The result is written to out, or to a buffer owned by this
+        transform that is overwritten on the next call.
+        If region is a (row slice, col slice) of the warped image, only that part is computed and returned
+        """
+        top, bottom, left, right = region_bounds(image.shape, region)
+        out_shape = (bottom - top, right - left) + image.shape[2:]
+        if out is None:
+            if self.buffer is None or self.buffer.shape != out_shape or self.buffer.dtype != image.dtype:
+                self.buffer = np.empty(out_shape, dtype=image.dtype)
+            out = self.buffer
+
+        if self.use_remap:
+            map1, map2 = self.remap_tables(image.shape, region)
+            warped = cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=out)
+        else:
+            warped = cv2.warpPerspective(image, self.matrix(image.shape, region), (out_shape[1], out_shape[0]),
+                                         dst=out)
+        if warped is not out:
+            out[...] = warped
+        return out
+
+
+# Returns (top, bottom, left, right) for a (row slice, col slice) region of an image, or the whole image
+def region_bounds(shape, region):
+    if region is None:
+        return 0, shape[0], 0, shape[1]
+    rows = region[0].indices(shape[0])
+    cols = region[1].indices(shape[1])
+    return rows[0], rows[1], cols[0], cols[1]
+
+
+default_transform = PerspectiveTransform()
+
+
+# Projects several sets of pixels into world coords with one rotation/translation/scale matrix multiply.
+# pixel_indices is a sequence of flat pixel index arrays, e.g. np.flatnonzero() of each mask.
+# Returns a list with an (x_world, y_world) pair for each set, like image_to_world()
+def pixels_to_world(pixel_indices, coord_table, xpos, ypos, yaw, world_size, scale):
+    yaw_rad = yaw * np.pi / 180
+    cos_yaw = np.cos(yaw_rad) / scale
+    sin_yaw = np.sin(yaw_rad) / scale
+    affine = np.float32([[cos_yaw, -sin_yaw, xpos],
+                         [sin_yaw, cos_yaw, ypos]])
+
+    world = affine @ np.take(coord_table.xy1, np.concatenate(pixel_indices), axis=1)
+    world = np.clip(world.astype(np.int_), 0, world_size - 1)
+
+    splits = np.cumsum([len(indices) for indices in pixel_indices])[:-1]
+    return [(x, y) for x, y in zip(np.split(world[0], splits), np.split(world[1], splits))]
+
+
 # Define a function to perform a perspective transform
 def perspective_transform(image):
-    dst_size = 5
-    bottom_offset = 6
-    source = np.float32([[7, 146], [313, 146], [200, 97], [120, 97]])
-    destination = np.float32([[image.shape[1] / 2 - dst_size, image.shape[0] - bottom_offset],
-                              [image.shape[1] / 2 + dst_size, image.shape[0] - bottom_offset],
-                              [image.shape[1] / 2 + dst_size, image.shape[0] - 2 * dst_size - bottom_offset],
-                              [image.shape[1] / 2 - dst_size, image.shape[0] - 2 * dst_size - bottom_offset],
-                              ])
-    M = cv2.getPerspectiveTransform(source, destination)
-    warped = cv2.warpPerspective(image, M, (image.shape[1], image.shape[0]))  # keep same size as input image
-
-    return warped
+    return default_transform.warp(image, np.empty_like(image))
 
 
 # Return true if rover is stable enough to record map data
@@ -140,35 +313,97 @@ def stable(rover):
     return True
 
 
+# Converts world pixel coordinates into flat indices into one channel of the worldmap
+def world_to_flat(world_x, world_y, world_size):
+    return world_y * world_size + world_x
+
+
+# Counts how many times each flat index appears. Returns (cells, counts) for every index that appears.
+# A frame only covers a small window of the map, so only that window is counted
+def count_cells(indices):
+    if len(indices) == 0:
+        return indices, indices
+    low = indices.min()
+    counts = np.bincount(indices - low)
+    cells = np.flatnonzero(counts)
+    return cells + low, counts[cells]
+
+
+NO_CHANGES = np.zeros(0, dtype=np.int64)
+
+
+# Largest values stored in the worldmap channels (obstacle, sample, navigable)
+MAP_LIMITS = np.array([255, np.iinfo(np.uint16).max, np.iinfo(np.uint16).max])
+
+
+# Applies one frame's map update, as stored in rover.map_update by perception_step.
+# Every pixel counts, including several pixels that land in the same cell, and only the touched cells
+# are clamped to MAP_LIMITS.
+# Returns the flat indices of the cells whose obstacle value changed
+def apply_map_update(worldmap, map_update):
+    (obs_cells, obs_counts), (sam_cells, sam_counts), (nav_cells, nav_counts) = map_update
+    flat_map = worldmap.reshape(-1, worldmap.shape[2])  # view with one row per map cell
+
+    flat_map[sam_cells, 1] = np.minimum(flat_map[sam_cells, 1] + sam_counts, MAP_LIMITS[1])
+    flat_map[nav_cells, 2] = np.minimum(flat_map[nav_cells, 2] + nav_counts, MAP_LIMITS[2])
+
+    # navigable pixels remove obstacle data, and the obstacle value can't go below 0
+    cells = np.concatenate([obs_cells, nav_cells])
+    if len(cells) == 0:
+        return cells
+    low = cells.min()
+    deltas = np.bincount(cells - low, weights=np.concatenate([obs_counts, -nav_counts]))
+    touched = np.flatnonzero(np.bincount(cells - low))
+    old_obstacle = flat_map[touched + low, 0]
+    new_obstacle = np.clip(old_obstacle + deltas[touched], 0, MAP_LIMITS[0])
+    flat_map[touched + low, 0] = new_obstacle
+    return touched[new_obstacle != old_obstacle] + low
+
+
 # Apply the above functions in succession and update the Rover state accordingly
-def perception_step(rover):
-    warped = perspective_transform(rover.img)
-    navigable = trim(get_navigable(warped))
-    obstacle = trim(get_obstacle(warped))
-    sample = trim(hsv_thresh(warped))
-
-    # update rover's vision for debugging
-    rover.vision_image[:, :, 0] = obstacle * 255
-    rover.vision_image[:, :, 1] = sample * 255
-    rover.vision_image[:, :, 2] = navigable * 255
-
-    xpos = rover.pos[0]
-    ypos = rover.pos[1]
-    yaw = rover.yaw
-    nav_world_x, nav_world_y = image_to_world(navigable, xpos, ypos, yaw, rover.worldmap.shape[0], 10)
-    obs_world_x, obs_world_y = image_to_world(obstacle, xpos, ypos, yaw, rover.worldmap.shape[0], 10)
-    sam_world_x, sam_world_y = image_to_world(sample, xpos, ypos, yaw, rover.worldmap.shape[0], 10)
+# Set update_map to False to only record the frame's map update in rover.map_update,
+# e.g. when the updates are applied somewhere else. Otherwise the obstacle cells that changed
+# are recorded in rover.obstacle_changes
+def perception_step(rover, update_map=True):
+    # the whole view is warped unless the transform is set to only warp the part that classify() keeps
+    region = rover.masks.roi if rover.perspective.region_warp else None
+    with metrics.timer('perspective_transform'):
+        warped = rover.perspective.warp(rover.img, region=region)
+
+    with metrics.timer('thresholding'):
+        navigable, obstacle, sample = classify(warped, rover.masks)
+
+        # update rover's vision for debugging
+        np.multiply(obstacle, 255, out=rover.vision_image[:, :, 0])
+        np.multiply(sample, 255, out=rover.vision_image[:, :, 1])
+        np.multiply(navigable, 255, out=rover.vision_image[:, :, 2])
+
+        # the masks only hold 0 and 1, and numpy finds nonzero entries much faster in boolean arrays
+        obs_pixels = np.flatnonzero(obstacle.view(bool))
+        sam_pixels = np.flatnonzero(sample.view(bool))
+        nav_pixels = np.flatnonzero(navigable.view(bool))
+    coord_table = get_coord_table(navigable.shape)
 
     if stable(rover):
-        rover.worldmap[obs_world_y, obs_world_x, 0] += 1
-        rover.worldmap[sam_world_y, sam_world_x, 1] += 1
-        rover.worldmap[nav_world_y, nav_world_x, 2] += 1
-        rover.worldmap[nav_world_y, nav_world_x, 0] -= 1  # remove obstacle data if navigable
-        rover.worldmap[:, :, 0] = np.clip(rover.worldmap[:, :, 0], 0, 255)  # don't let obstacle value go below 0
-
-    nav_rover_x, nav_rover_y = rover_coords(navigable)
-    dist, angles = to_polar_coords(nav_rover_x, nav_rover_y)
-    rover.nav_angles = angles
-    rover.nav_dists = dist
+        with metrics.timer('world_projection'):
+            world_size = rover.worldmap.shape[0]
+            (obs_world_x, obs_world_y), (sam_world_x, sam_world_y), (nav_world_x, nav_world_y) = \
+                pixels_to_world((obs_pixels, sam_pixels, nav_pixels), coord_table,
+                                rover.pos[0], rover.pos[1], rover.yaw, world_size, 10)
+            rover.map_update = (count_cells(world_to_flat(obs_world_x, obs_world_y, world_size)),
+                                count_cells(world_to_flat(sam_world_x, sam_world_y, world_size)),
+                                count_cells(world_to_flat(nav_world_x, nav_world_y, world_size)))
+        if update_map:
+            with metrics.timer('map_update'):
+                rover.obstacle_changes = apply_map_update(rover.worldmap, rover.map_update)
+                if rover.sample_locator is not None:
+                    rover.samples_located = rover.sample_locator.update(rover.map_update[1][0])
+    else:
+        rover.map_update = None
+        rover.obstacle_changes = NO_CHANGES
+
+    nav_angles, nav_dists = rover.nav_buffers(len(nav_pixels))
+    np.take(coord_table.angle, nav_pixels, out=nav_angles)
+    np.take(coord_table.dist, nav_pixels, out=nav_dists)
 
     return rover
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+import numpy as np
+from instrumentation import metrics
+from latest_worker import LatestWorker
+
+log = logging.getLogger('planner')
+
+
+class BackgroundPlanner:
+    """
+    Runs path planning on a worker thread so a slow replan never holds up the telemetry loop.
+    request_plan() hands over a snapshot of the pose, goal and costs without waiting, and take_new_path()
+    returns each finished path once, unless it has gone stale. Only the newest request is kept, so the worker
+    always plans from the freshest data instead of working through a backlog.
+    """
+
+    def __init__(self, navigator, replan_interval=0.2, max_path_age=1.0, threaded=True, max_points=None):
+        """
+        :param navigator: planner with a find_path(start, goal, costs, changed, max_points) method,
+        only used from the worker
+        :param replan_interval: minimum number of seconds between replans towards the same goal
+        :param max_path_age: paths planned from a request older than this many seconds are considered stale
+        and not returned
+        :param threaded: if False, request_plan() plans before it returns
+        :param max_points: only extract this many points of each path, or None for the whole path.
+        The path cache replans when the rover reaches the end of a shortened path
+        """
+        self.navigator = navigator
+        self.replan_interval = replan_interval
+        self.max_path_age = max_path_age
+        self.max_points = max_points
+        # plans (start, goal, costs, changed, request time) requests, only the newest one is kept
+        self.worker = LatestWorker(lambda request: self.plan(*request), 'planner', threaded, merge_requests)
+        self.lock = threading.Lock()  # guards the path fields below
+        self.last_request_time = -np.inf
+        self.last_goal = None
+        self.path = None
+        self.path_goal = None
+        self.path_time = -np.inf  # when the request the path was planned from was made
+        self.path_taken = True  # whether take_new_path() has returned the current path
+
+    def due(self, goal):
+        """
+        Returns true if a new plan should be requested, either because the goal changed or because
+        replan_interval has passed since the last request
+        """
+        return goal != self.last_goal or time.time() - self.last_request_time >= self.replan_interval
+
+    def request_plan(self, start, goal, costs, changed):
+        """
+        Asks for a path from start to goal. Returns straight away unless the planner isn't threaded
+        :param changed: (rows, cols) of the costs that changed since the previous request
+        """
+        self.last_request_time = time.time()
+        self.last_goal = goal
+        costs = costs.copy()  # the caller keeps updating its costs in place
+        self.worker.submit((start, goal, costs, changed, self.last_request_time))
+
+    def take_new_path(self):
+        """
+        Returns (path, goal, request time) if a plan has finished since the last call, otherwise None.
+        The path is None if the goal couldn't be reached. Plans whose request is older than max_path_age
+        are skipped, their pose and costs are out of date
+        """
+        with self.lock:
+            if self.path_taken or time.time() - self.path_time > self.max_path_age:
+                return None
+            self.path_taken = True
+            return self.path, self.path_goal, self.path_time
+
+    def plan(self, start, goal, costs, changed, request_time):
+        path = None
+        if not inside(goal, costs.shape):
+            log.warning('Goal %s is outside the %s cost map', goal, costs.shape)
+        else:
+            # the rover can be reported just past the edge of the map, plan from the closest cell
+            start = clamp(start, costs.shape)
+            try:
+                with metrics.timer('dstar_replan'):
+                    path = self.navigator.find_path(start, goal, costs, changed, self.max_points)
+            except ValueError:
+                # no path to this goal with the current costs
+                pass
+            except Exception:
+                # keep the worker alive, the rover follows the open ground until a later plan works
+                log.exception('Planning from %s to %s failed', start, goal)
+                if hasattr(self.navigator, 'last_goal'):
+                    # its search state may be half updated, start over on the next request
+                    self.navigator.last_goal = None
+        with self.lock:
+            self.path = path
+            self.path_goal = goal
+            self.path_time = request_time
+            self.path_taken = False
+
+    def stop(self):
+        """
+        Ends the worker thread after the plan in progress. A request that hasn't been planned yet is dropped
+        """
+        self.worker.stop()
+
+
+def merge_requests(older, newer):
+    # the older request was never planned, keep its cost changes
+    _, _, _, (rows, cols), _ = older
+    start, goal, costs, changed, request_time = newer
+    return start, goal, costs, (np.concatenate([rows, changed[0]]), np.concatenate([cols, changed[1]])), request_time
+
+
+def inside(cell, shape):
+    return 0 <= cell[0] < shape[0] and 0 <= cell[1] < shape[1]
+
+
+def clamp(cell, shape):
+    return min(max(cell[0], 0), shape[0] - 1), min(max(cell[1], 0), shape[1] - 1)
@@ -0,0 +1,112 @@
+class PriorityQueue:
+    """
+    Binary min-heap that keeps track of where each item lives, so that an item's key can be
+    decreased, increased or removed in O(log n) without scanning the queue.
+    Each item can only be in the queue once.
+    """
+
+    def __init__(self):
+        self.keys = []  # heap of keys
+        self.items = []  # items, stored in the same order as the keys
+        self.positions = {}  # item -> index in the heap
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def top(self):
+        """
+        Returns the (key, item) pair with the smallest key without removing it
+        """
+        return self.keys[0], self.items[0]
+
+    def top_key(self):
+        return self.keys[0]
+
+    def pop(self):
+        """
+        Removes and returns the (key, item) pair with the smallest key
+        """
+        key, item = self.keys[0], self.items[0]
+        self._remove_at(0)
+        return key, item
+
+    def insert(self, item, key):
+        """
+        Adds an item to the queue, or moves it to its new position if it is already queued
+        """
+        position = self.positions.get(item)
+        if position is None:
+            self.keys.append(key)
+            self.items.append(item)
+            self.positions[item] = len(self.items) - 1
+            self._sift_up(len(self.items) - 1)
+            return
+
+        old_key = self.keys[position]
+        self.keys[position] = key
+        if key < old_key:
+            self._sift_up(position)
+        elif old_key < key:
+            self._sift_down(position)
+
+    update = insert
+
+    def remove(self, item):
+        """
+        Removes an item from the queue. Does nothing if the item is not queued
+        """
+        position = self.positions.get(item)
+        if position is not None:
+            self._remove_at(position)
+
+    def _remove_at(self, position):
+        last = len(self.items) - 1
+        del self.positions[self.items[position]]
+        if position == last:
+            self.keys.pop()
+            self.items.pop()
+            return
+
+        # fill the hole with the last entry and restore the heap around it
+        self.keys[position] = self.keys.pop()
+        self.items[position] = self.items.pop()
+        self.positions[self.items[position]] = position
+        self._sift_down(position)
+        self._sift_up(position)
+
+    def _move(self, source, destination):
+        self.keys[destination] = self.keys[source]
+        self.items[destination] = self.items[source]
+        self.positions[self.items[destination]] = destination
+
+    def _sift_up(self, position):
+        key, item = self.keys[position], self.items[position]
+        while position > 0:
+            parent = (position - 1) >> 1
+            if not key < self.keys[parent]:
+                break
+            self._move(parent, position)
+            position = parent
+        self.keys[position] = key
+        self.items[position] = item
+        self.positions[item] = position
+
+    def _sift_down(self, position):
+        key, item = self.keys[position], self.items[position]
+        size = len(self.items)
+        child = 2 * position + 1
+        while child < size:
+            right = child + 1
+            if right < size and self.keys[right] < self.keys[child]:
+                child = right
+            if not self.keys[child] < key:
+                break
+            self._move(child, position)
+            position = child
+            child = 2 * position + 1
+        self.keys[position] = key
+        self.items[position] = item
+        self.positions[item] = position
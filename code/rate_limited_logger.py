@@ -0,0 +1,34 @@
+import logging
+import time
+
+
+class RateLimitedLogger:
+    """
+    Wraps a logging.Logger so that each kind of message is logged at most once every interval seconds.
+    Messages are only formatted when they are actually logged, so skipped messages cost almost nothing.
+    """
+
+    def __init__(self, name, interval=1.0):
+        """
+        :param name: name of the underlying logging.Logger
+        :param interval: minimum number of seconds between two messages with the same key
+        """
+        self.logger = logging.getLogger(name)
+        self.interval = interval
+        self.last_logged = {}
+
+    def log(self, key, level, message, *args):
+        """
+        Logs message % args unless a message with the same key was logged less than interval seconds ago
+        """
+        now = time.time()
+        if now - self.last_logged.get(key, -self.interval) < self.interval:
+            return
+        self.last_logged[key] = now
+        self.logger.log(level, message, *args)
+
+    def info(self, key, message, *args):
+        self.log(key, logging.INFO, message, *args)
+
+    def debug(self, key, message, *args):
+        self.log(key, logging.DEBUG, message, *args)
@@ -0,0 +1,115 @@
+"""
+Replays a recorded dataset through perception_step() to build a worldmap offline.
+
+Frames are processed in parallel by a pool of worker processes. Each worker returns the frame's
+map update (cells and pixel counts), and the updates are applied to a single worldmap in log order,
+so the result is the same as processing the frames one at a time.
+
+Example:
+    $ python replay.py ../test_dataset/robot_log.csv --output ../output/replay_worldmap.npy
+"""
+import argparse
+import csv
+import os
+import time
+from multiprocessing import Pool
+import cv2
+import numpy as np
+
+from perception import perception_step, apply_map_update
+from rover_state import RoverState
+
+# each worker process keeps its own rover, created by init_worker
+worker_rover = None
+
+
+def read_log(csv_path):
+    """
+    Yields (image_path, (x, y), yaw, pitch, roll) for every frame in a robot_log.csv file
+    """
+    log_dir = os.path.dirname(os.path.abspath(csv_path))
+    with open(csv_path) as log_file:
+        for row in csv.DictReader(log_file, delimiter=';'):
+            image_path = row['Path']
+            if not os.path.isabs(image_path) and not os.path.exists(image_path):
+                # paths are recorded relative to wherever the simulator was run from,
+                # fall back to the IMG folder next to the log
+                image_path = os.path.join(log_dir, 'IMG', os.path.basename(image_path))
+            yield (image_path,
+                   (float(row['X_Position']), float(row['Y_Position'])),
+                   float(row['Yaw']), float(row['Pitch']), float(row['Roll']))
+
+
+def read_image(image_path):
+    # the simulator sends RGB images, opencv reads BGR
+    return cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+
+
+def init_worker():
+    global worker_rover
+    worker_rover = RoverState()
+
+
+def process_frame(frame):
+    """
+    Runs perception on a single frame and returns its map update, or None if the rover wasn't stable
+    """
+    image_path, pos, yaw, pitch, roll = frame
+    rover = worker_rover
+    rover.img = read_image(image_path)
+    rover.pos = pos
+    rover.yaw = yaw
+    rover.pitch = pitch
+    rover.roll = roll
+    perception_step(rover, update_map=False)
+    return rover.map_update
+
+
+def replay(csv_path, workers=None, chunksize=16):
+    """
+    Runs every frame in a log through perception and accumulates the results into one worldmap
+    :param csv_path: path to robot_log.csv
+    :param workers: number of worker processes, defaults to the number of cores
+    :param chunksize: number of frames sent to a worker at a time
+    :return: worldmap, number of frames processed, elapsed seconds
+    """
+    worldmap = RoverState().worldmap
+    frames = 0
+    start_time = time.time()
+    with Pool(workers, initializer=init_worker) as pool:
+        # imap returns results in the order the frames were submitted
+        for map_update in pool.imap(process_frame, read_log(csv_path), chunksize):
+            frames += 1
+            if map_update is not None:
+                apply_map_update(worldmap, map_update)
+    return worldmap, frames, time.time() - start_time
+
+
+def save_map_image(worldmap, image_path):
+    # same colors as the notebook: obstacles red, samples green, navigable blue
+    plotmap = np.clip(worldmap, 0, 255).astype(np.uint8)
+    cv2.imwrite(image_path, cv2.cvtColor(np.flipud(plotmap), cv2.COLOR_RGB2BGR))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded dataset through perception')
+    parser.add_argument('csv_path', type=str, nargs='?', default='../test_dataset/robot_log.csv',
+                        help='Path to the robot_log.csv file to replay.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes. Defaults to the number of cores.')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='Number of frames sent to a worker at a time.')
+    parser.add_argument('--output', type=str, default='',
+                        help='Save the final worldmap to this .npy file, along with a .png preview.')
+    args = parser.parse_args()
+
+    worldmap, frames, elapsed = replay(args.csv_path, args.workers, args.chunksize)
+    print('Replayed {} frames in {:.2f} s ({:.1f} fps)'.format(frames, elapsed, frames / elapsed))
+    print('Mapped cells: navigable {}, obstacle {}, sample {}'.format(
+        np.count_nonzero(worldmap[:, :, 2]), np.count_nonzero(worldmap[:, :, 0]),
+        np.count_nonzero(worldmap[:, :, 1])))
+
+    if args.output != '':
+        np.save(args.output, worldmap)
+        save_map_image(worldmap, os.path.splitext(args.output)[0] + '.png')
+        print('Saved worldmap to {}'.format(args.output))
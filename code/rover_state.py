@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import matplotlib.image as mpimg
+from perception import ThresholdMasks, PerspectiveTransform
+from frontier import FrontierIndex
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+ground_truth = mpimg.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'calibration_images', 'map_bw.png'))
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying 
+# map output looks green in the display image
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float64)
+# Total number of navigable pixels in the ground truth map, for the mapped percentage
+ground_truth_pixels = float(np.count_nonzero(ground_truth_3d[:,:,1]))
+
+# Define RoverState() class to retain rover state parameters
+# __slots__ keeps every rover compact and turns a misspelled field into an AttributeError
+class RoverState():
+    __slots__ = ('start_time', 'total_time', 'img', 'pos', 'yaw', 'pitch', 'roll', 'vel', 'steer', 'throttle',
+                 'brake', 'nav_count', 'nav_angle_buffer', 'nav_dist_buffer', 'ground_truth', 'mode',
+                 'throttle_set', 'brake_set', 'stop_forward', 'go_forward', 'max_vel', 'vision_image',
+                 'perspective', 'masks', 'worldmap', 'map_update', 'obstacle_changes', 'samples_pos',
+                 'samples_to_find', 'samples_located', 'samples_found', 'sample_locator', 'samples_collected',
+                 'near_sample', 'picking_up', 'send_pickup', 'navigation', 'unexplored', 'frontier')
+
+    def __init__(self):
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.img = None # Current camera image
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_count = None # Number of navigable terrain pixels, None before the first perception step
+        self.nav_angle_buffer = np.zeros(0, dtype=np.float32) # Reused by every frame, see nav_buffers()
+        self.nav_dist_buffer = np.zeros(0, dtype=np.float32)
+        self.ground_truth = ground_truth_3d # Ground truth worldmap
+        self.mode = 'forward' # Current mode (can be forward or stop)
+        self.throttle_set = 0.2 # Throttle setting when accelerating
+        self.brake_set = 10 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.stop_forward = 50 # Threshold to initiate stopping
+        self.go_forward = 500 # Threshold to go forward again
+        self.max_vel = 1.5 # Maximum velocity (meters/second)
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8) 
+        self.perspective = PerspectiveTransform() # Camera to top down transform and its output buffer
+        self.masks = ThresholdMasks((160, 320)) # Navigable/obstacle/sample masks, reused every frame
+        # Worldmap
+        # Update this image with the positions of navigable terrain
+        # obstacles and rock samples
+        # Each cell counts the pixels seen there, see perception.MAP_LIMITS
+        self.worldmap = np.zeros((200, 200, 3), dtype=np.uint16) 
+        self.map_update = None # (flat worldmap cells, pixel counts) for obstacle, sample and navigable this frame
+        self.obstacle_changes = None # Flat indices of worldmap cells whose obstacle value changed this frame
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_located = 0 # To store number of samples located on map
+        self.samples_found = None # Whether each sample has been located on the map
+        self.sample_locator = None # Updates the two fields above from new rock detections, made once samples_pos is known
+        self.samples_collected = 0 # To count the number of samples collected
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        self.navigation = None # decision.Navigation with this rover's cost map and planner, made on the first decision step
+        self.unexplored = ground_truth_3d[:,:,1] == 255 # True for navigable cells the rover hasn't been near
+        self.frontier = FrontierIndex(self.unexplored) # Finds the unexplored cells closest to the rover
+
+    # Angles and distances of the navigable terrain pixels, None before the first perception step.
+    # These are views of buffers that the next frame overwrites, copy them to keep them longer
+    @property
+    def nav_angles(self):
+        if self.nav_count is None:
+            return None
+        return self.nav_angle_buffer[:self.nav_count]
+
+    @property
+    def nav_dists(self):
+        if self.nav_count is None:
+            return None
+        return self.nav_dist_buffer[:self.nav_count]
+
+    def nav_buffers(self, count):
+        """
+        Sets the number of navigable pixels and returns (angles, distances) arrays of that length to fill in.
+        The buffers only grow, by doubling, so they soon stop being reallocated
+        """
+        if count > len(self.nav_angle_buffer):
+            size = max(count, 2 * len(self.nav_angle_buffer))
+            self.nav_angle_buffer = np.zeros(size, dtype=np.float32)
+            self.nav_dist_buffer = np.zeros(size, dtype=np.float32)
+        self.nav_count = count
+        return self.nav_angle_buffer[:count], self.nav_dist_buffer[:count]
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class SampleLocator:
+    """
+    Keeps track of which known rock samples have been located on the worldmap.
+    A sample counts as located once a rock is detected in a cell closer than radius to it. Every cell of the
+    map stores a bit mask of the samples it is close to, so new detections are checked with one lookup
+    instead of measuring the distance from every sample to every detection.
+    """
+
+    def __init__(self, samples_pos, shape=(200, 200), radius=3):
+        """
+        :param samples_pos: (x positions, y positions) of the samples, at most 64 of them
+        :param shape: (rows, cols) of the worldmap
+        :param radius: detections closer than this to a sample locate it
+        """
+        samples_x, samples_y = (np.asarray(pos, dtype=np.int64) for pos in samples_pos)
+        if len(samples_x) > 64:
+            raise ValueError('can only track up to 64 samples, not ' + str(len(samples_x)))
+        self.samples_x = samples_x
+        self.samples_y = samples_y
+        self.shape = shape
+        self.found = np.zeros(len(samples_x), dtype=bool)
+
+        self.nearby = np.zeros(shape, dtype=np.uint64)
+        reach = int(np.ceil(radius))
+        offsets = np.arange(-reach, reach + 1)
+        d_y, d_x = np.meshgrid(offsets, offsets, indexing='ij')
+        close = d_x ** 2 + d_y ** 2 < radius ** 2
+        d_x, d_y = d_x[close], d_y[close]
+        for sample, (x, y) in enumerate(zip(samples_x, samples_y)):
+            rows, cols = y + d_y, x + d_x
+            inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+            self.nearby[rows[inside], cols[inside]] |= np.uint64(1 << sample)
+
+    @property
+    def located(self):
+        return int(np.count_nonzero(self.found))
+
+    def update(self, cells):
+        """
+        Marks the samples near newly detected rock cells as found
+        :param cells: flat indices of worldmap cells with rock detections
+        :return: number of samples located so far
+        """
+        if len(cells) > 0 and not self.found.all():
+            bits = np.bitwise_or.reduce(self.nearby.ravel()[cells])
+            self.found |= (bits >> np.arange(len(self.found), dtype=np.uint64)) & np.uint64(1) == 1
+        return self.located
+
+    def update_from_map(self, sample_map):
+        """
+        Checks every detection in the sample layer of a worldmap, e.g. one made before the locator existed
+        """
+        return self.update(np.flatnonzero(sample_map))
@@ -0,0 +1,183 @@
+"""
+Per-rover state of the telemetry server, so several simulators can drive their own rovers from one server.
+
+Each socketio connection gets a Session with its own RoverState, planner and display pipeline, keyed by the
+connection's sid. LocalSessions runs them all in this process. ShardedSessions spreads them over worker
+processes so that rovers use separate cores; a session always stays on the worker that started it, because
+its state lives there.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+import decision
+from decision import decision_step
+from display import DisplayPipeline
+from instrumentation import metrics
+from perception import perception_step
+from rover_state import RoverState
+from supporting_functions import update_rover
+
+
+class Session:
+    """
+    Everything the server keeps for one connected rover
+    """
+
+    def __init__(self, name, display_rate=5.0, display_threaded=True, image_folder=''):
+        """
+        :param name: the socketio sid, also added to the names of saved camera images
+        :param image_folder: save every camera image here, unless it is empty
+        """
+        self.name = name
+        self.rover = RoverState()
+        self.display = DisplayPipeline(rate=display_rate, threaded=display_threaded)
+        self.image_folder = image_folder
+
+    def handle(self, data):
+        """
+        Runs one telemetry event through perception and decision
+        :return: ('pickup',) or ('control', (throttle, brake, steer), image_string1, image_string2)
+        """
+        # Initialize / update Rover with current telemetry
+        with metrics.timer('update_rover'):
+            self.rover, image = update_rover(self.rover, data)
+        rover = self.rover
+
+        if np.isfinite(rover.vel):
+            # Execute the perception and decision steps to update the Rover's state
+            with metrics.timer('perception'):
+                rover = perception_step(rover)
+            with metrics.timer('decision'):
+                rover = decision_step(rover)
+
+            # Queue output images to send to server, and send the newest ones that are ready
+            self.display.submit(rover)
+            image_string1, image_string2 = self.display.latest_images()
+
+            # only one of pickup or control can be sent, both make the simulator send new telemetry
+            if rover.send_pickup and not rover.picking_up:
+                rover.send_pickup = False
+                reply = ('pickup',)
+            else:
+                reply = ('control', (rover.throttle, rover.brake, rover.steer), image_string1, image_string2)
+        else:
+            # In case of invalid telemetry, send null commands and empty images
+            reply = ('control', (0, 0, 0), '', '')
+
+        if self.image_folder != '':
+            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+            image_filename = os.path.join(self.image_folder, '{}_{}.jpg'.format(timestamp, self.name))
+            cv2.imwrite(image_filename, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        return reply
+
+    def close(self):
+        """
+        Stops the rover's planner and display threads
+        """
+        self.display.stop()
+        if self.rover.navigation is not None:
+            self.rover.navigation.planner.stop()
+
+
+class LocalSessions:
+    """
+    Runs every session in this process
+    """
+
+    def __init__(self, **session_args):
+        """
+        :param session_args: keyword arguments for every new Session
+        """
+        self.session_args = session_args
+        self.sessions = {}  # sid: Session
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def handle(self, sid, data):
+        """
+        Returns the reply to a telemetry event, see Session.handle(). Starts a session for new sids
+        """
+        if sid not in self.sessions:
+            self.sessions[sid] = Session(sid, **self.session_args)
+        return self.sessions[sid].handle(data)
+
+    def end(self, sid):
+        session = self.sessions.pop(sid, None)
+        if session is not None:
+            session.close()
+
+    def shutdown(self):
+        for sid in list(self.sessions):
+            self.end(sid)
+
+
+# sessions of a worker process of ShardedSessions
+worker_sessions = None
+
+
+def start_worker(session_args, navigation_settings, log_level):
+    global worker_sessions
+    logging.basicConfig(level=log_level, format='%(asctime)s %(name)s: %(message)s')
+    decision.navigation_settings.update(navigation_settings)
+    worker_sessions = LocalSessions(**session_args)
+
+
+def worker_handle(sid, data):
+    return worker_sessions.handle(sid, data)
+
+
+def worker_end(sid):
+    worker_sessions.end(sid)
+
+
+class ShardedSessions:
+    """
+    Runs sessions on worker processes, each new session going to the worker with the fewest.
+    Stage timings are recorded in the workers, so this process's metrics only see whole frames
+    """
+
+    def __init__(self, workers, wait=None, log_level='INFO', **session_args):
+        """
+        :param workers: number of worker processes
+        :param wait: function that waits for a concurrent.futures.Future and returns its result, e.g. one
+        that keeps an event loop running meanwhile. Future.result() by default
+        :param session_args: keyword arguments for every new Session
+        """
+        # the workers start with a copy of the current navigation settings
+        initargs = (session_args, dict(decision.navigation_settings), log_level)
+        self.shards = [ProcessPoolExecutor(max_workers=1, initializer=start_worker, initargs=initargs)
+                       for _ in range(workers)]
+        self.assigned = {}  # sid: index of the shard that has its session
+        self.wait = wait if wait is not None else (lambda future: future.result())
+
+    def __len__(self):
+        return len(self.assigned)
+
+    def shard(self, sid):
+        if sid not in self.assigned:
+            loads = [0] * len(self.shards)
+            for index in self.assigned.values():
+                loads[index] += 1
+            self.assigned[sid] = loads.index(min(loads))
+        return self.shards[self.assigned[sid]]
+
+    def handle(self, sid, data):
+        """
+        Returns the reply to a telemetry event from the session's worker, see Session.handle()
+        """
+        return self.wait(self.shard(sid).submit(worker_handle, sid, data))
+
+    def end(self, sid):
+        index = self.assigned.pop(sid, None)
+        if index is not None:
+            self.shards[index].submit(worker_end, sid)
+
+    def shutdown(self):
+        for shard in self.shards:
+            shard.shutdown(wait=False)
@@ -0,0 +1,276 @@
+"""
+Headless stand-in for the Unity simulator, for closed loop load tests of drive_rover.py.
+
+It connects to the socketio server like the simulator does and sends the camera frames of a recorded
+robot_log.csv as telemetry events. The rover's pose comes from a simple kinematic model that follows the
+throttle, brake and steering sent back, and stops at the walls of calibration_images/map_bw.png. The camera
+image doesn't match the simulated pose, so this measures how fast the server runs, not how well it drives.
+
+Every telemetry event waits for the server's answer, like the simulator, so the round trip latency and the
+sustained frames per second are the end to end throughput of drive_rover.py.
+
+Needs the python-socketio client (version 4 or newer). Example, with drive_rover.py running:
+    $ python sim_client.py ../test_dataset/robot_log.csv --rate 0 --duration 60 --output ../output/load.json
+"""
+import argparse
+import base64
+import json
+import math
+import queue
+import time
+
+import numpy as np
+import socketio
+
+from benchmark import timing_stats
+from replay import read_log
+from rover_state import ground_truth
+
+
+class KinematicRover:
+    """
+    Bicycle model of the rover on the ground truth map, roughly tuned to feel like the simulator
+    """
+
+    def __init__(self, x, y, yaw, navigable=ground_truth, max_speed=2.0, acceleration=2.5, braking=1.0,
+                 drag=0.2, wheelbase=1.0, turn_rate=30.0):
+        """
+        :param x, y: start position in map cells (meters)
+        :param yaw: start heading in degrees, counterclockwise from the x axis
+        :param navigable: map indexed [y, x], nonzero where the rover can drive
+        :param acceleration: m/s^2 at full throttle
+        :param braking: m/s^2 per unit of brake
+        :param drag: fraction of the speed lost per second when coasting
+        :param wheelbase: meters between the axles, sets the turning circle
+        :param turn_rate: degrees per second at full steering when turning in place
+        """
+        self.x = x
+        self.y = y
+        self.yaw = yaw
+        self.speed = 0.0
+        self.navigable = navigable
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+        self.braking = braking
+        self.drag = drag
+        self.wheelbase = wheelbase
+        self.turn_rate = turn_rate
+        self.blocked_steps = 0  # steps where a wall stopped the rover
+        self.distance = 0.0
+
+    def can_drive(self, x, y):
+        row, col = int(y), int(x)
+        return 0 <= row < self.navigable.shape[0] and 0 <= col < self.navigable.shape[1] and \
+            self.navigable[row, col] > 0
+
+    def step(self, throttle, brake, steer, dt):
+        """
+        Moves the rover forward by dt seconds
+        :param steer: steering angle in degrees, the simulator limits it to +/- 15
+        """
+        steer = float(np.clip(steer, -15, 15))
+        if self.speed < 0.05 and throttle == 0 and brake == 0:
+            # the simulator turns in place when the rover is stopped and steering
+            self.yaw += self.turn_rate * steer / 15 * dt
+        else:
+            self.yaw += math.degrees(self.speed * math.tan(math.radians(steer)) / self.wheelbase) * dt
+        self.yaw %= 360
+
+        change = throttle * self.acceleration - brake * self.braking - self.drag * self.speed
+        self.speed = float(np.clip(self.speed + change * dt, 0, self.max_speed))
+
+        step = self.speed * dt
+        x = self.x + step * math.cos(math.radians(self.yaw))
+        y = self.y + step * math.sin(math.radians(self.yaw))
+        if self.can_drive(x, y):
+            self.x, self.y = x, y
+            self.distance += step
+        else:
+            self.speed = 0.0
+            self.blocked_steps += 1
+
+
+class SampleField:
+    """
+    Rock samples at random navigable cells, for the sample fields of the telemetry
+    """
+
+    def __init__(self, count=6, seed=0, navigable=ground_truth):
+        cells = np.argwhere(navigable > 0)
+        chosen = cells[np.random.default_rng(seed).choice(len(cells), count, replace=False)]
+        self.y, self.x = chosen[:, 0], chosen[:, 1]
+        self.collected = np.zeros(count, dtype=bool)
+
+    def nearest(self, x, y):
+        """
+        Returns the index of the closest sample that hasn't been collected, and its distance
+        """
+        distances = np.where(self.collected, np.inf, np.hypot(self.x - x, self.y - y))
+        index = int(np.argmin(distances))
+        return index, distances[index]
+
+
+def format_number(value):
+    return '{:.6f}'.format(value)
+
+
+def telemetry(rover, samples, image_string, throttle, steer, near_distance=1.5):
+    """
+    Builds a telemetry event with the same fields and formatting as the simulator
+    """
+    _, distance = samples.nearest(rover.x, rover.y)
+    return {'speed': format_number(rover.speed),
+            'position': format_number(rover.x) + ';' + format_number(rover.y),
+            'yaw': format_number(rover.yaw),
+            'pitch': format_number(0),
+            'roll': format_number(0),
+            'throttle': format_number(throttle),
+            'steering_angle': format_number(steer),
+            'near_sample': str(int(distance < near_distance)),
+            'picking_up': '0',
+            'sample_count': str(int(np.count_nonzero(~samples.collected))),
+            'samples_x': ';'.join(format_number(x) for x in samples.x),
+            'samples_y': ';'.join(format_number(y) for y in samples.y),
+            'image': image_string}
+
+
+def drain(answers):
+    """
+    Throws away every queued answer and returns how many there were
+    """
+    count = 0
+    while True:
+        try:
+            answers.get_nowait()
+        except queue.Empty:
+            return count
+        count += 1
+
+
+def load_images(csv_path, limit=None):
+    """
+    Returns the first pose of the log and every camera image as a base64 JPEG string, ready to send
+    """
+    images = []
+    first_pose = None
+    for image_path, pos, yaw, _, _ in read_log(csv_path):
+        if first_pose is None:
+            first_pose = (pos[0], pos[1], yaw)
+        with open(image_path, 'rb') as image_file:
+            images.append(base64.b64encode(image_file.read()).decode('utf-8'))
+        if limit is not None and len(images) >= limit:
+            break
+    return first_pose, images
+
+
+def run(url, csv_path, rate=25.0, duration=30.0, max_frames=None, sim_dt=0.04, timeout=2.0, seed=0):
+    """
+    Drives the server at url with telemetry until duration seconds have passed
+    :param rate: telemetry events per second, 0 to send the next one as soon as the answer arrives
+    :param sim_dt: seconds of simulated time per frame, fixed so that runs are repeatable
+    :param timeout: seconds to wait for an answer before counting the frame as dropped
+    :return: dict of results
+    """
+    (x, y, yaw), images = load_images(csv_path, max_frames)
+    rover = KinematicRover(x, y, yaw)
+    samples = SampleField(seed=seed)
+    throttle = steer = brake = 0.0
+
+    answers = queue.Queue()
+    client = socketio.Client()
+    client.on('data', lambda data: answers.put(('data', data, time.perf_counter())))
+    client.on('pickup', lambda data: answers.put(('pickup', data, time.perf_counter())))
+    client.on('manual', lambda data: answers.put(('manual', data, time.perf_counter())))
+    client.connect(url)
+
+    # the server says hello with an empty control message, which isn't an answer to anything
+    time.sleep(0.5)
+    drain(answers)
+
+    round_trips = []
+    dropped = 0
+    late = 0  # answers that came after their frame was counted as dropped
+    pickups = 0
+    start = time.perf_counter()
+    next_send = start
+    frame = 0
+    try:
+        while time.perf_counter() - start < duration:
+            if rate > 0:
+                time.sleep(max(0.0, next_send - time.perf_counter()))
+                next_send += 1.0 / rate
+
+            event = telemetry(rover, samples, images[frame % len(images)], throttle, steer)
+            frame += 1
+            # answers carry no frame number, so anything still queued is a late answer to an earlier frame
+            late += drain(answers)
+            sent = time.perf_counter()
+            client.emit('telemetry', event)
+            try:
+                kind, data, received = answers.get(timeout=timeout)
+            except queue.Empty:
+                dropped += 1
+                # wait for the late answer before sending more, so it isn't taken as the next frame's answer
+                try:
+                    answers.get(timeout=timeout)
+                    late += 1
+                except queue.Empty:
+                    pass
+                continue
+            round_trips.append(received - sent)
+
+            if kind == 'data':
+                throttle, brake, steer = (float(data[field] or 0) for field in ('throttle', 'brake', 'steering_angle'))
+            elif kind == 'pickup':
+                pickups += 1
+                index, distance = samples.nearest(rover.x, rover.y)
+                if distance < 1.5:
+                    samples.collected[index] = True
+            rover.step(throttle, brake, steer, sim_dt)
+        elapsed = time.perf_counter() - start
+    finally:
+        client.disconnect()
+
+    results = {'round_trip': timing_stats(round_trips),
+               'frames_sent': frame,
+               'frames_answered': len(round_trips),
+               'dropped': dropped,
+               'late_answers': late,
+               'elapsed_s': elapsed,
+               'sustained_fps': len(round_trips) / elapsed,
+               'target_rate': rate,
+               'distance_m': rover.distance,
+               'blocked_steps': rover.blocked_steps,
+               'pickups': pickups,
+               'samples_collected': int(np.count_nonzero(samples.collected))}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless simulator stand-in for load testing drive_rover.py')
+    parser.add_argument('csv_path', type=str, nargs='?', default='../test_dataset/robot_log.csv',
+                        help='Path to the robot_log.csv file whose camera frames are sent.')
+    parser.add_argument('--url', type=str, default='http://localhost:4567',
+                        help='Address of the drive_rover.py server.')
+    parser.add_argument('--rate', type=float, default=25,
+                        help='Telemetry events per second, 0 for as fast as the server answers.')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Number of seconds to run for.')
+    parser.add_argument('--max-frames', type=int, default=None,
+                        help='Only load this many frames of the log, they are sent in a loop.')
+    parser.add_argument('--sim-dt', type=float, default=0.04,
+                        help='Simulated seconds per frame for the kinematic model.')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='Seconds to wait for an answer before counting a frame as dropped.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the rock sample positions.')
+    parser.add_argument('--output', type=str, default='',
+                        help='Also write the results to this JSON file.')
+    args = parser.parse_args()
+
+    results = run(args.url, args.csv_path, args.rate, args.duration, args.max_frames, args.sim_dt,
+                  args.timeout, args.seed)
+    print(json.dumps(results, indent=2))
+    if args.output != '':
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
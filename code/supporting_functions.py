@@ -1,67 +1,104 @@
 import numpy as np
 import cv2
-from PIL import Image
-from io import BytesIO, StringIO
 import base64
 import time
+from rate_limited_logger import RateLimitedLogger
+from rover_state import ground_truth_pixels
+from samples import SampleLocator
+from instrumentation import metrics
+
+# Telemetry is logged at most once per second instead of on every frame
+log = RateLimitedLogger('telemetry', interval=1.0)
+
+# Numeric telemetry fields, in the order parse_telemetry() returns them. Position has two values
+TELEMETRY_FIELDS = ('speed', 'position', 'yaw', 'pitch', 'roll', 'throttle', 'steering_angle',
+                    'near_sample', 'picking_up', 'sample_count')
 
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
-      if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
-      else: 
-            float_value = np.float(string_to_convert)
-      return float_value
+      return float(string_to_convert.replace(',', '.'))
+
+def parse_floats(string_to_convert):
+      """
+      Converts a string of numbers separated by ; to a float array, independent of decimal convention
+      """
+      return np.array(string_to_convert.replace(',', '.').split(';'), dtype=np.float64)
+
+def parse_telemetry(data):
+      """
+      Parses all numeric fields in TELEMETRY_FIELDS at once, with a single decimal replace and float conversion
+      :return: array of speed, x, y, yaw, pitch, roll, throttle, steering angle, near sample, picking up and sample count
+      """
+      return parse_floats(';'.join([data[field] for field in TELEMETRY_FIELDS]))
+
+def decode_image(image_string, out=None):
+      """
+      Decodes a base64 JPEG string from the simulator into an RGB image
+      :param out: existing image of the right size and type to decode into instead of allocating a new one
+      """
+      encoded = np.frombuffer(base64.b64decode(image_string), dtype=np.uint8)
+      # opencv decodes to BGR, the simulator images and the rest of the pipeline are RGB
+      return cv2.cvtColor(cv2.imdecode(encoded, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB, dst=out)
 
 def update_rover(Rover, data):
       # Initialize start time and sample positions
       if Rover.start_time == None:
             Rover.start_time = time.time()
             Rover.total_time = 0
-            samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-            samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
+            samples_xpos = np.int_(parse_floats(data["samples_x"]))
+            samples_ypos = np.int_(parse_floats(data["samples_y"]))
             Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.sample_locator = SampleLocator(Rover.samples_pos, Rover.worldmap.shape[:2])
+            Rover.samples_found = Rover.sample_locator.found
+            Rover.samples_located = Rover.sample_locator.update_from_map(Rover.worldmap[:,:,1])
+            Rover.samples_to_find = int(data["sample_count"])
       # Or just update elapsed time
       else:
             tot_time = time.time() - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
-      # Print out the fields in the telemetry data dictionary
-      print(data.keys())
+      # Log the fields in the telemetry data dictionary
+      log.debug('keys', 'Telemetry fields: %s', list(data.keys()))
+      speed, xpos, ypos, yaw, pitch, roll, throttle, steer, near_sample, picking_up, sample_count = \
+            parse_telemetry(data).tolist()
       # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
+      Rover.vel = speed
       # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
+      Rover.pos = [xpos, ypos]
       # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
+      Rover.yaw = yaw
       # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
+      Rover.pitch = pitch
       # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
+      Rover.roll = roll
       # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
+      Rover.throttle = throttle
       # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
+      Rover.steer = steer
       # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
+      Rover.near_sample = int(near_sample)
       # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+      Rover.picking_up = int(picking_up)
       # Update number of rocks collected
-      Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
-
-      print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples collected:', Rover.samples_collected)
-      # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      Rover.samples_collected = Rover.samples_to_find - int(sample_count)
+
+      log.info('status', 'speed = %s position = %s throttle = %s steer_angle = %s near_sample: %s '
+               'picking_up: %s sending pickup: %s total time: %s samples remaining: %s samples collected: %s',
+               Rover.vel, Rover.pos, Rover.throttle, Rover.steer, Rover.near_sample, Rover.picking_up,
+               Rover.send_pickup, Rover.total_time, int(sample_count), Rover.samples_collected)
+      # Get the current image from the center camera of the rover, reusing the last frame's buffer
+      with metrics.timer('decode'):
+            Rover.img = decode_image(data["image"], out=Rover.img)
 
       # Return updated Rover and separate image for optional saving
-      return Rover, image
+      return Rover, Rover.img
+
+def encode_image(image):
+      """
+      Encodes an RGB uint8 image as a base64 JPEG string
+      """
+      _, buff = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+      return base64.b64encode(buff).decode("utf-8")
 
 # Define a function to create display output given worldmap results
 def create_output_images(Rover):
@@ -80,43 +117,32 @@ def create_output_images(Rover):
 
       likely_nav = navigable >= obstacle
       obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
+      plotmap = np.zeros(Rover.worldmap.shape, dtype=np.float64)
       plotmap[:, :, 0] = obstacle
       plotmap[:, :, 2] = navigable
       plotmap = plotmap.clip(0, 255)
       # Overlay obstacle and navigable terrain map with ground truth map
       map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
 
-      # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-      # If there are, we'll step through the known sample positions
-      # to confirm whether detections are real
-      samples_located = 0
-      if rock_world_pos[0].any():
-            
+      # Plot the location of the known samples that rocks were detected near, see samples.SampleLocator
+      samples_located = Rover.samples_located
+      if samples_located > 0:
             rock_size = 2
-            for idx in range(len(Rover.samples_pos[0])):
-                  test_rock_x = Rover.samples_pos[0][idx]
-                  test_rock_y = Rover.samples_pos[1][idx]
-                  rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-                  # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
-                  if np.min(rock_sample_dists) < 3:
-                        samples_located += 1
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+            found = Rover.samples_found
+            for test_rock_x, test_rock_y in zip(Rover.samples_pos[0][found], Rover.samples_pos[1][found]):
+                  map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+                  test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
 
       # Calculate some statistics on the map results
       # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
+      nav_map = plotmap[:,:,2] > 0
+      tot_nav_pix = float(np.count_nonzero(nav_map))
       # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-      # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
+      good_nav_pix = float(np.count_nonzero(nav_map & (Rover.ground_truth[:,:,1] > 0)))
+      # The rest do not correspond to ground truth pixels
+      bad_nav_pix = tot_nav_pix - good_nav_pix
+      # Grab the total number of map pixels, which never changes
+      tot_map_pix = ground_truth_pixels
       # Calculate the percentage of ground truth map that has been successfully found
       perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
       # Calculate the number of good map pixel detections divided by total pixels 
@@ -126,7 +152,7 @@ def create_output_images(Rover):
       else:
             fidelity = 0
       # Flip the map for plotting so that the y-axis points upward in the display
-      map_add = np.flipud(map_add).astype(np.float32)
+      map_add = np.flipud(map_add).clip(0, 255).astype(np.uint8)
       # Add some text about map and rock sample detection results
       cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -141,15 +167,8 @@ def create_output_images(Rover):
       cv2.putText(map_add,"  Collected: "+str(Rover.samples_collected), (0, 85), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       # Convert map and vision image to base64 strings for sending to server
-      pil_img = Image.fromarray(map_add.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-      
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+      encoded_string1 = encode_image(map_add)
+      encoded_string2 = encode_image(Rover.vision_image)
 
       return encoded_string1, encoded_string2
 
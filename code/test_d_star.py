@@ -0,0 +1,87 @@
+"""
+Regression tests for incremental D* Lite replans, run with pytest from this directory
+"""
+import heapq
+import math
+
+import numpy as np
+
+from d_star import DStarNavigator
+
+
+def optimal_cost(costs, start, goal):
+    # Dijkstra with D*'s cost model: stepping into a cell costs the cell's cost plus the step length
+    best = {start: 0.0}
+    queue = [(0.0, start)]
+    while queue:
+        cost, cell = heapq.heappop(queue)
+        if cell == goal:
+            return cost
+        if cost > best[cell]:
+            continue
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                neighbor = (cell[0] + d_row, cell[1] + d_col)
+                if (d_row or d_col) and 0 <= neighbor[0] < costs.shape[0] and 0 <= neighbor[1] < costs.shape[1]:
+                    new_cost = cost + costs[neighbor] + math.hypot(d_row, d_col)
+                    if new_cost < best.get(neighbor, math.inf):
+                        best[neighbor] = new_cost
+                        heapq.heappush(queue, (new_cost, neighbor))
+    return math.inf
+
+
+def path_cost(costs, start, path):
+    cost = 0.0
+    for previous, point in zip([start] + path[:-1], path):
+        cost += costs[point] + math.hypot(point[0] - previous[0], point[1] - previous[1])
+    return cost
+
+
+def replan(costs, new_costs, first_start, start, goal):
+    costs, new_costs = np.array(costs, dtype=float), np.array(new_costs, dtype=float)
+    navigator = DStarNavigator(storage='dense', sensing_radius=None)
+    navigator.find_path(first_start, goal, costs)
+    path = navigator.find_path(start, goal, new_costs, new_costs != costs)
+    assert path[-1] == goal
+    return path_cost(new_costs, start, path), optimal_cost(new_costs, start, goal)
+
+
+def test_replan_is_optimal_when_keys_tie():
+    # the start's k1 and a stale cell's k1 are the same value computed in different orders, one bit apart
+    costs = [[2, 3, 0, 0], [1, 0, 3, 1], [0, 0, 1, 1], [2, 3, 0, 2], [1, 3, 0, 0], [1, 1, 2, 3]]
+    new_costs = [row[:] for row in costs]
+    new_costs[5][2] = 3
+    cost, optimum = replan(costs, new_costs, (3, 0), (2, 1), (5, 2))
+    assert cost == optimum
+
+
+def test_replan_does_not_go_in_circles():
+    costs = [[0, 3, 1, 3, 3], [0, 0, 1, 0, 2], [2, 3, 0, 3, 0], [1, 0, 0, 0, 2], [2, 0, 0, 0, 3],
+             [3, 1, 3, 1, 3], [0, 3, 0, 2, 2], [1, 1, 2, 2, 2]]
+    new_costs = [row[:] for row in costs]
+    new_costs[2][0] = 3
+    cost, optimum = replan(costs, new_costs, (4, 3), (5, 4), (2, 0))
+    assert abs(cost - optimum) < 1e-9
+
+
+def test_random_replans_are_optimal():
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        shape = tuple(int(size) for size in rng.integers(3, 9, 2))
+        costs = rng.integers(0, 4, shape).astype(float)
+        start, goal = (tuple(int(value) for value in rng.integers(0, shape)) for _ in range(2))
+        if start == goal:
+            continue
+        navigator = DStarNavigator(storage='dense', sensing_radius=None)
+        navigator.find_path(start, goal, costs)
+        for _ in range(3):
+            new_costs = costs.copy()
+            cells = rng.integers(0, costs.size, rng.integers(1, 4))
+            new_costs.flat[cells] = rng.integers(0, 4, len(cells))
+            start = tuple(int(np.clip(value + step, 0, size - 1))
+                          for value, step, size in zip(start, rng.integers(-1, 2, 2), shape))
+            if start == goal:
+                break
+            path = navigator.find_path(start, goal, new_costs, new_costs != costs)
+            assert abs(path_cost(new_costs, start, path) - optimal_cost(new_costs, start, goal)) < 1e-9
+            costs = new_costs